@@ -60,13 +60,40 @@
 
 import math
 import numpy as np
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 import matplotlib.pyplot as plt
 
 
+# The membership functions also take a NumPy array of any shape, so a whole universe or batch of inputs is fuzzified in one call. Arrays are computed without branching on x: a triangle or trapezoid is the minimum of its rising and its falling edge, each clipped to [0, 1]. A single number still goes through plain Python, which is faster than a NumPy call per value.
+
 # In[3]:
 
-class TriangularMF:
+# Counts the edits of mfs, variables, rules, rulebases and reasoner settings.
+# A reasoner compiles its rules at one count and compiles them again on its
+# next call once the count has moved on.
+edits = 0
+
+
+def edited():
+    global edits
+    edits += 1
+
+
+class Tracked(object):
+    """Every attribute set on it counts as an edit."""
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        edited()
+
+
+def ramp(x, start, end):
+    """Rises from 0 at start to 1 at end, a step at start if they meet."""
+    if end > start:
+        return np.clip((x - start) / (end - start), 0, 1)
+    return (x >= start).astype(float)
+
+
+class TriangularMF(Tracked):
     """Triangular fuzzy logic membership function class."""
     def __init__(self, name, start, top, end):
         self.name = name
@@ -75,14 +102,20 @@ class TriangularMF:
         self.end = end
 
     def calculate_membership(self, x):
-        if x<self.start or x>self.end:
-            return 0
-        if x>self.top:
-            return (self.end-x)/(self.end-self.top)
-        return (x-self.start)/(self.top-self.start)
+        if isinstance(x, (int, float)):
+            if x<self.start or x>self.end:
+                return 0
+            if x>self.top:
+                return (self.end-x)/(self.end-self.top)
+            return (x-self.start)/(self.top-self.start)
+        x = np.asarray(x, dtype=float)
+        return np.minimum(ramp(x, self.start, self.top), ramp(-x, -self.end, -self.top))
+
+    def vertices(self):
+        return [(self.start, 0), (self.top, 1), (self.end, 0)]
 
 
-class TrapezoidalMF:
+class TrapezoidalMF(Tracked):
     """Trapezoidal fuzzy logic membership function class."""
     def __init__(self, name, start, left_top, right_top, end):
         self.name = name
@@ -92,20 +125,55 @@ class TrapezoidalMF:
         self.end = end
 
     def calculate_membership(self, x):
-        if x<self.start or x>self.end:
-            return 0
-        if x>=self.left_top and x<=self.right_top:
-            return 1
-        if x>self.right_top:
-            return (self.end-x)/(self.end-self.right_top)
-        return (x-self.start)/(self.left_top-self.start)
+        if isinstance(x, (int, float)):
+            if x<self.start or x>self.end:
+                return 0
+            if x>=self.left_top and x<=self.right_top:
+                return 1
+            if x>self.right_top:
+                return (self.end-x)/(self.end-self.right_top)
+            return (x-self.start)/(self.left_top-self.start)
+        x = np.asarray(x, dtype=float)
+        return np.minimum(ramp(x, self.start, self.left_top), ramp(-x, -self.end, -self.right_top))
+
+    def vertices(self):
+        return [(self.start, 0), (self.left_top, 1), (self.right_top, 1), (self.end, 0)]
+
+
+class GaussianMF(Tracked):
+    """Gaussian fuzzy logic membership function class."""
+    def __init__(self, name, mean, sigma):
+        self.name = name
+        self.mean = mean
+        self.sigma = sigma
+
+    def calculate_membership(self, x):
+        if isinstance(x, (int, float)):
+            return math.exp(-0.5 * ((x - self.mean) / self.sigma)**2)
+        x = np.asarray(x, dtype=float)
+        return np.exp(-0.5 * ((x - self.mean) / self.sigma)**2)
+
+
+class BellMF(Tracked):
+    """Generalized bell fuzzy logic membership function class, with width a,
+    slope b and center c."""
+    def __init__(self, name, a, b, c):
+        self.name = name
+        self.a = a
+        self.b = b
+        self.c = c
+
+    def calculate_membership(self, x):
+        if not isinstance(x, (int, float)):
+            x = np.asarray(x, dtype=float)
+        return 1 / (1 + abs((x - self.c) / self.a)**(2 * self.b))
 
 
 # In[4]:
 
-x_list = range(0,30)
+x_list = np.arange(0,30)
 trapezoid = TrapezoidalMF('I member', 7, 10, 18, 25)
-y_list = [trapezoid.calculate_membership(x) for x in x_list]
+y_list = trapezoid.calculate_membership(x_list)
 plt.plot(x_list, y_list)
 plt.show()
 
@@ -147,7 +215,7 @@ print(trapezoidal_mf.calculate_membership(3.9))
 
 # In[6]:
 
-class Variable(object):
+class Variable(Tracked):
     """General class for variables in an FLS."""
     def __init__(self, name, range, mfs):
         self.name = name
@@ -244,7 +312,7 @@ print(output.calculate_memberships(222))
 
 # In[9]:
 
-class Rule:
+class Rule(Tracked):
     """Fuzzy rule class, initialized with an antecedent (list of strings),
     operator (string) and consequent (string)."""
     def __init__(self, n, antecedent, operator, consequent):
@@ -305,7 +373,7 @@ print(rule2.calculate_firing_strength([700, 3], inputs))
 
 from collections import Counter
 
-class Rulebase:
+class Rulebase(Tracked):
     """The fuzzy rulebase collects all rules for the FLS, can
     calculate the firing strengths of its rules."""
     def __init__(self, rules):
@@ -320,6 +388,52 @@ class Rulebase:
                 result[consequent] = fs
         return result
 
+    def compile(self, inputs, output):
+        return CompiledRulebase(self.rules, inputs, output)
+
+
+class CompiledRulebase:
+    """The rules as index arrays over the mfs of the inputs and the output:
+    antecedents[rule, input] is the index of the rule's mf of that input,
+    conjunctions[rule] is True for 'and' rules and consequents[rule] is the
+    index of its output mf. Each input is fuzzified once and the firing
+    strengths of all rules are gathered from that in one go."""
+    def __init__(self, rules, inputs, output):
+        self.inputs = inputs
+        self.output = output
+        names = [[mf.name for mf in variable.mfs] for variable in inputs]
+        self.antecedents = np.array([[names[i].index(term) for i, term in enumerate(rule.antecedent)]
+                                     for rule in rules], dtype=int).reshape(len(rules), len(inputs))
+        self.conjunctions = np.array([rule.operator == 'and' for rule in rules], dtype=bool)
+        outputs = [mf.name for mf in output.mfs]
+        self.consequents = np.array([outputs.index(rule.consequent) for rule in rules], dtype=int)
+        self.by_consequent = [np.flatnonzero(self.consequents == j) for j in range(len(outputs))]
+
+    def fuzzify(self, X):
+        """(n_inputs, most mfs of an input, n) memberships of the rows of X."""
+        X = np.asarray(X, dtype=float)
+        memberships = np.zeros((len(self.inputs), max(len(variable.mfs) for variable in self.inputs), len(X)))
+        for i, variable in enumerate(self.inputs):
+            # A single row is cheaper to fuzzify one float at a time
+            x = float(X[0, i]) if len(X) == 1 else X[:, i]
+            for j, mf in enumerate(variable.mfs):
+                memberships[i, j] = mf.calculate_membership(x)
+        return memberships
+
+    def rule_strengths(self, X):
+        """(n_rules, n) firing strengths of every rule for the rows of X."""
+        terms = self.fuzzify(X)[np.arange(len(self.inputs)), self.antecedents]
+        return np.where(self.conjunctions[:, None], terms.min(axis=1), terms.max(axis=1))
+
+    def firing_strengths(self, X):
+        """(n_output_mfs, n) highest firing strength per output mf."""
+        strengths = self.rule_strengths(X)
+        result = np.zeros((len(self.by_consequent), strengths.shape[1]))
+        for j, rules in enumerate(self.by_consequent):
+            if len(rules):
+                result[j] = strengths[rules].max(axis=0)
+        return result
+
 
 # In[15]:
 
@@ -384,20 +498,121 @@ print(rulebase.calculate_firing_strengths(datapoint, inputs))
 # In[51]:
 
 class Reasoner:
-    def __init__(self, rulebase, inputs, output, n_points, defuzzification):
+    """Mamdani inference, defuzzified with smallest (som), largest (lom) or
+    mean of max (mom), centroid or bisector. With analytic=True these are
+    computed exactly from the corners of triangular and trapezoidal output
+    mfs, without discretizing the output range.
+
+    enable_cache() memoizes inference() on datapoints rounded to a precision
+    per input. The rules are compiled once and again after an attribute of a
+    rule, rulebase, variable, mf or of the settings below is set. Changes
+    inside their lists, like appending a rule, are not seen: call
+    invalidate() after those."""
+    settings = ('rulebase', 'inputs', 'output', 'discretise', 'defuzzification', 'analytic')
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in self.settings:
+            edited()
+
+    def __init__(self, rulebase, inputs, output, n_points, defuzzification, analytic=False):
         self.rulebase = rulebase
         self.inputs = inputs
         self.output = output
         self.discretise = n_points
         self.defuzzification = defuzzification
+        self.analytic = analytic
+        if analytic:
+            exotic = [mf.name for mf in output.mfs if not hasattr(mf, 'vertices')]
+            if exotic:
+                raise ValueError('analytic=True needs triangular or trapezoidal output mfs, %s have no vertices' % ', '.join(exotic))
+        self.tables = {}
+        self.cache = None
+        # [hits, misses], in a list so counting them is not an edit
+        self.calls = [0, 0]
+        self.invalidate()
+
+    @property
+    def hits(self):
+        return self.calls[0]
+
+    @property
+    def misses(self):
+        return self.calls[1]
+
+    def invalidate(self):
+        """Recompile the rules and drop the output tables and the cache."""
+        self.compiled = self.rulebase.compile(self.inputs, self.output)
+        self.compiled_at = edits
+        self.tables.clear()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def enable_cache(self, size=1024, precision=None):
+        """Keep the outputs of the last `size` distinct datapoints. Inputs
+        are rounded to `precision`: one step for all inputs, a list with one
+        per input or a dict by input name, by default a thousandth of the
+        input's range. A datapoint is answered with the output at its
+        rounded value."""
+        steps = []
+        for i, variable in enumerate(self.inputs):
+            if precision is None:
+                step = (variable.range[1] - variable.range[0]) / 1000
+            elif isinstance(precision, dict):
+                step = precision.get(variable.name, (variable.range[1] - variable.range[0]) / 1000)
+            elif np.isscalar(precision):
+                step = precision
+            else:
+                step = precision[i]
+            steps.append(float(step))
+        self.precision = steps
+        self.cache_size = size
+        self.cache = OrderedDict()
+        self.calls = [0, 0]
+
+    def cache_info(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / calls if calls else 0.0,
+                'size': len(self.cache) if self.cache is not None else 0}
+
+    def table(self):
+        """The discretized output range and the (n_output_mfs, n_points)
+        memberships of its points, computed once per output and n_points."""
+        key = (self.output, self.discretise)
+        if key not in self.tables:
+            area = np.linspace(self.output.range[0], self.output.range[1], self.discretise)
+            self.tables[key] = area, np.array([mf.calculate_membership(area) for mf in self.output.mfs])
+        return self.tables[key]
 
     def inference(self, datapoint):
+        if self.cache is None:
+            return self.infer(datapoint)
+        if self.compiled_at != edits:
+            self.invalidate()
+        key = tuple(round(x / step) for x, step in zip(datapoint, self.precision))
+        if key in self.cache:
+            self.calls[0] += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.calls[1] += 1
+        crisp_output = self.cache[key] = self.infer([k * step for k, step in zip(key, self.precision)])
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return crisp_output
+
+    def infer(self, datapoint):
         # 1. Calculate the highest firing strength found in the rules per 
         # membership function of the output variable
         # looks like: {"low":0.5, "medium":0.25, "high":0}
         
         # Your code here
-        firing_strengths = self.rulebase.calculate_firing_strengths(datapoint, self.inputs)
+        if self.compiled_at != edits:
+            self.invalidate()
+        strengths = self.compiled.firing_strengths([datapoint])[:, 0]
+        if self.analytic:
+            return self.exact(strengths)
+        firing_strengths = Counter(dict(zip([mf.name for mf in self.output.mfs], strengths.tolist())))
 
         # 2. Aggregate and discretize
         # looks like: [(0.0, 1), (1.2437810945273631, 1), (2.4875621890547261, 1), (3.7313432835820892, 1), ...]
@@ -412,15 +627,14 @@ class Reasoner:
         
         # First find where the aggregated area starts and ends
         # Your code here
-        area = np.linspace(self.output.range[0], self.output.range[1], self.discretise)
+        area, table = self.table()
         
         # Second discretize this area and aggragate
         # Your code here
-        pts = []
-        for pt in area:
-            pts.append((pt, max([min(firing_strengths[mf.name], mf.calculate_membership(pt)) for mf in self.output.mfs])))
+        strengths = np.array([firing_strengths[mf.name] for mf in self.output.mfs], dtype=float)
+        values = np.minimum(strengths[:, None], table).max(axis=0)
 
-        return pts
+        return list(zip(area.tolist(), values.tolist()))
 
     def defuzzify(self, input_value_pairs):
         # Your code here
@@ -432,7 +646,160 @@ class Reasoner:
             max_val = max(reversed(input_value_pairs), key=lambda x: x[1])
             return max_val[0]
 
-        return crisp_value
+        area, values = np.array(input_value_pairs).T
+        return float(self.defuzzify_rows(area, values[None])[0])
+
+    def defuzzify_rows(self, area, aggregated):
+        """Defuzzify every row of the (n, len(area)) aggregated array."""
+        if self.defuzzification == 'som':
+            return area[aggregated.argmax(axis=1)]
+        if self.defuzzification == 'lom':
+            return area[len(area) - 1 - aggregated[:, ::-1].argmax(axis=1)]
+        if self.defuzzification == 'mom':
+            tops = aggregated == aggregated.max(axis=1, keepdims=True)
+            return tops @ area / tops.sum(axis=1)
+        # Nothing fired: the middle of the range
+        total = aggregated.sum(axis=1)
+        empty = total <= 0
+        middle = (area[0] + area[-1]) / 2
+        if self.defuzzification == 'centroid':
+            return np.where(empty, middle, aggregated @ area / np.where(empty, 1, total))
+        if self.defuzzification == 'bisector':
+            # The first point at which the cumulative area reaches half of the total
+            cumulative = np.cumsum(aggregated, axis=1)
+            half = (cumulative < cumulative[:, -1:] / 2).sum(axis=1)
+            return np.where(empty, middle, area[np.minimum(half, len(area) - 1)])
+        raise ValueError('unknown defuzzification %r' % self.defuzzification)
+
+    def exact(self, strengths):
+        """Defuzzify the output mfs clipped at their firing strengths without
+        discretizing: the aggregated output is piecewise linear, so it is
+        known exactly from its value at the corners of the clipped mfs and
+        at the points where two of them cross."""
+        low, high = self.output.range
+        xs = [low, high]
+        for mf, s in zip(self.output.mfs, strengths):
+            corners = mf.vertices()
+            xs += [x for x, y in corners]
+            for (x0, y0), (x1, y1) in zip(corners, corners[1:]):
+                if min(y0, y1) < s < max(y0, y1):
+                    xs.append(x0 + (s - y0) * (x1 - x0) / (y1 - y0))
+        xs = np.unique(np.clip(xs, low, high))
+
+        def lines(xs):
+            # Between two consecutive points every clipped mf is linear, so
+            # its values at both ends follow from two points in between,
+            # which also gives the limits at the steps of shoulder mfs.
+            a, b = xs[:-1], xs[1:]
+            p, q = a + (b - a) / 3, a + 2 * (b - a) / 3
+            fp = np.minimum(strengths[:, None], [mf.calculate_membership(p) for mf in self.output.mfs])
+            fq = np.minimum(strengths[:, None], [mf.calculate_membership(q) for mf in self.output.mfs])
+            return a, b, 2 * fp - fq, 2 * fq - fp
+
+        a, b, left, right = lines(xs)
+        crossings = []
+        for j in range(len(strengths)):
+            for l in range(j):
+                at_a, at_b = left[j] - left[l], right[j] - right[l]
+                crossed = at_a * at_b < 0
+                at_a, at_b = at_a[crossed], at_b[crossed]
+                crossings += (a[crossed] + at_a / (at_a - at_b) * (b - a)[crossed]).tolist()
+        if crossings:
+            a, b, left, right = lines(np.unique(np.concatenate([xs, crossings])))
+        left, right = left.max(axis=0), right.max(axis=0)
+
+        height = max(left.max(), right.max())
+        at_left = np.isclose(left, height, rtol=0, atol=1e-12)
+        at_right = np.isclose(right, height, rtol=0, atol=1e-12)
+        if self.defuzzification in ('som', 'lom', 'mom'):
+            tops = np.concatenate([a[at_left], b[at_right]])
+            if self.defuzzification == 'som':
+                return float(tops.min())
+            if self.defuzzification == 'lom':
+                return float(tops.max())
+            # The mean of the plateaus at the maximum, weighted by their
+            # length, or of the peaks if the maximum is only reached at points
+            plateau = at_left & at_right
+            if plateau.any():
+                return float(((a + b) / 2 * (b - a))[plateau].sum() / (b - a)[plateau].sum())
+            return float(np.unique(tops).mean())
+        areas = (left + right) / 2 * (b - a)
+        total = areas.sum()
+        if total <= 0:
+            return (low + high) / 2
+        if self.defuzzification == 'centroid':
+            return float(((b - a) * (a * (2 * left + right) + b * (left + 2 * right)) / 6).sum() / total)
+        if self.defuzzification == 'bisector':
+            # Solve for the point of the segment where the area reaches half
+            # of the total, the area under the segment up to t is
+            # left * t + slope * t**2 / 2
+            before = np.cumsum(areas) - areas
+            k = max(np.searchsorted(before, total / 2) - 1, 0)
+            rest = total / 2 - before[k]
+            slope = (right[k] - left[k]) / (b[k] - a[k])
+            if abs(slope) < 1e-12:
+                return float(a[k] + rest / left[k])
+            return float(a[k] + (np.sqrt(left[k]**2 + 2 * slope * rest) - left[k]) / slope)
+        raise ValueError('unknown defuzzification %r' % self.defuzzification)
+
+    def infer_batch(self, X):
+        """inference() for every row of the (n, n_inputs) array X at once."""
+        X = np.asarray(X, dtype=float)
+        if self.compiled_at != edits:
+            self.invalidate()
+
+        # 1. Fuzzify every input once and 2. gather the firing strengths
+        # of all rules from that, the highest per output mf
+        firing_strengths = self.compiled.firing_strengths(X)
+        if self.analytic:
+            return np.array([self.exact(strengths) for strengths in firing_strengths.T])
+
+        # 3. Aggregate over the discretized output range, an (n, n_points) array
+        area, table = self.table()
+        aggregated = np.zeros((len(X), len(area)))
+        for j, curve in enumerate(table):
+            np.maximum(aggregated, np.minimum(firing_strengths[j][:, None], curve), out=aggregated)
+
+        # 4. Defuzzify every row
+        return self.defuzzify_rows(area, aggregated)
+
+
+class TSKConsequent(Tracked):
+    """Consequent of a TSK rule: a constant, or a linear function of the
+    inputs given as [constant, coefficient of input 1, ...]."""
+    def __init__(self, name, coefficients):
+        self.name = name
+        self.coefficients = tuple(np.atleast_1d(coefficients).astype(float).tolist())
+
+    def calculate_output(self, X):
+        X = np.asarray(X, dtype=float)
+        if len(self.coefficients) == 1:
+            return np.full(len(X), self.coefficients[0])
+        return self.coefficients[0] + X @ np.array(self.coefficients[1:])
+
+
+class TSKReasoner(Reasoner):
+    """Takagi-Sugeno-Kang inference: the crisp output is the average of the
+    consequents of the rules weighted by their firing strengths, so there
+    is no output range to aggregate over. The output's mfs are
+    TSKConsequents and rules name them like Mamdani consequents."""
+    def __init__(self, rulebase, inputs, output):
+        super(TSKReasoner, self).__init__(rulebase, inputs, output, 0, 'tsk')
+
+    def infer(self, datapoint):
+        return float(self.infer_batch([datapoint])[0])
+
+    def infer_batch(self, X):
+        X = np.asarray(X, dtype=float)
+        if self.compiled_at != edits:
+            self.invalidate()
+        strengths = self.compiled.rule_strengths(X)
+        outputs = np.array([consequent.calculate_output(X) for consequent in self.output.mfs])
+        total = strengths.sum(axis=0)
+        weighted = (strengths * outputs[self.compiled.consequents]).sum(axis=0)
+        # Nothing fired: the middle of the range
+        middle = (self.output.range[0] + self.output.range[1]) / 2
+        return np.where(total > 0, weighted / np.where(total > 0, total, 1), middle)
 
 
 # In[52]:
@@ -464,3 +831,168 @@ thinker = Reasoner(rulebase, inputs, output, 201, "lom")
 datapoint = [900, 6.5]
 print(round(thinker.inference(datapoint)))
 
+
+
+# ## 6. Task priority
+# 
+# The fuzzy scheduler in cfs.py can weigh its tasks with a reasoner like the one above, see `cfs.FuzzyWeights`. Its inputs are named after task features: nice level, runtime (seconds the task ran ahead of the others), wait (seconds since it was last started) and due (seconds until its due date). The output is an effective nice level: the lower, the larger the task's share of the cpu.
+# 
+# Every input has an 'Any' membership function that is 1 over its whole range, so a rule can leave an input out of its antecedent.
+
+# In[53]:
+
+def anything(range):
+    low, high = range
+    return TrapezoidalMF('Any', low - 1, low, high, high + 1)
+
+
+def priority_reasoner(runtime=1.0, wait=1.0, horizon=60.0, n_points=201):
+    """Reasoner from nice, runtime, wait and due to an effective nice."""
+    nice = Input('nice', (-20, 19), [
+        TrapezoidalMF('Low', -21, -20, -10, 0),
+        TriangularMF('Normal', -10, 0, 10),
+        TrapezoidalMF('High', 0, 10, 19, 20),
+        anything((-20, 19))])
+    ran = Input('runtime', (0, runtime), [
+        TrapezoidalMF('Short', -1, 0, 0.1 * runtime, 0.5 * runtime),
+        TrapezoidalMF('Long', 0.1 * runtime, 0.5 * runtime, runtime,
+                      runtime + 1),
+        anything((0, runtime))])
+    waited = Input('wait', (0, wait), [
+        TrapezoidalMF('Short', -1, 0, 0.2 * wait, 0.6 * wait),
+        TrapezoidalMF('Long', 0.2 * wait, 0.6 * wait, wait, wait + 1),
+        anything((0, wait))])
+    due = Input('due', (0, horizon), [
+        TrapezoidalMF('Soon', -1, 0, 0.1 * horizon, 0.3 * horizon),
+        TrapezoidalMF('Late', 0.1 * horizon, 0.3 * horizon, horizon,
+                      horizon + 1),
+        anything((0, horizon))])
+    priority = Output('priority', (-20, 19), [
+        TrapezoidalMF('High', -21, -20, -15, -5),
+        TriangularMF('Normal', -10, 0, 10),
+        TrapezoidalMF('Low', 5, 15, 19, 20)])
+    rules = [Rule(1, ['Low', 'Any', 'Any', 'Any'], 'and', 'High'),
+             Rule(2, ['Normal', 'Any', 'Any', 'Any'], 'and', 'Normal'),
+             Rule(3, ['High', 'Any', 'Any', 'Any'], 'and', 'Low'),
+             Rule(4, ['Any', 'Long', 'Short', 'Late'], 'and', 'Low'),
+             Rule(5, ['Any', 'Any', 'Long', 'Any'], 'and', 'High'),
+             Rule(6, ['Any', 'Any', 'Any', 'Soon'], 'and', 'High')]
+    return Reasoner(Rulebase(rules), [nice, ran, waited, due], priority,
+                    n_points, 'centroid')
+
+
+# ## 7. Lookup table
+# 
+# A controller with two or three inputs can be evaluated once over a grid of its input ranges, after which a decision is a multilinear interpolation between the corners of the grid cell the datapoint falls in. The finer the grid the closer this is to the reasoner; `max_error` is the largest difference found on random datapoints. Defuzzifiers that jump, like som and lom, keep an error of the size of the jump next to it.
+
+# In[54]:
+
+from itertools import product
+
+class LookupTable:
+    """Crisp outputs of a reasoner over a grid of `resolution` points per
+    input, interpolated multilinearly. It has the inputs, inference() and
+    infer_batch() of the reasoner, so it can stand in for it, e.g. in the
+    FuzzyWeights of cfs.py. Tables of two and three inputs are read in
+    closed form."""
+    def __init__(self, reasoner, resolution=65, samples=1000, seed=0):
+        self.reasoner = reasoner
+        self.inputs = reasoner.inputs
+        n_inputs = len(reasoner.inputs)
+        if np.isscalar(resolution):
+            resolution = [resolution] * n_inputs
+        self.resolution = [int(r) for r in resolution]
+        if min(self.resolution) < 2:
+            raise ValueError('resolution needs at least 2 points per input, got %r' % (resolution,))
+        self.lows = [float(variable.range[0]) for variable in reasoner.inputs]
+        self.highs = [float(variable.range[1]) for variable in reasoner.inputs]
+        axes = [np.linspace(low, high, r) for low, high, r in zip(self.lows, self.highs, self.resolution)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, n_inputs)
+        self.table = np.asarray(reasoner.infer_batch(grid), dtype=float).reshape(self.resolution)
+        # Row-major offsets, so the table can be read as a flat list
+        self.strides = [int(np.prod(self.resolution[i + 1:])) for i in range(n_inputs)]
+        self.values = self.table.ravel().tolist()
+        self.corners = list(product((0, 1), repeat=n_inputs))
+        # Per input its low, grid steps per unit and last cell
+        self.axes = [(low, (r - 1) / (high - low), r - 2)
+                     for low, high, r in zip(self.lows, self.highs, self.resolution)]
+        if n_inputs == 2:
+            self.inference = self.bilinear
+        elif n_inputs == 3:
+            self.inference = self.trilinear
+
+        rng = np.random.default_rng(seed)
+        X = rng.uniform(self.lows, self.highs, size=(samples, n_inputs))
+        self.max_error = float(np.abs(self.infer_batch(X) - reasoner.infer_batch(X)).max()) if samples else None
+
+    def inference(self, datapoint):
+        cells = []
+        for x, low, high, r, stride in zip(datapoint, self.lows, self.highs, self.resolution, self.strides):
+            position = min(max((x - low) / (high - low), 0.0), 1.0) * (r - 1)
+            i = min(int(position), r - 2)
+            cells.append((i * stride, stride, position - i))
+        result = 0.0
+        for corner in self.corners:
+            offset, weight = 0, 1.0
+            for bit, (base, stride, fraction) in zip(corner, cells):
+                if bit:
+                    offset += base + stride
+                    weight *= fraction
+                else:
+                    offset += base
+                    weight *= 1 - fraction
+            result += weight * self.values[offset]
+        return result
+
+    def bilinear(self, datapoint):
+        (low_x, scale_x, last_x), (low_y, scale_y, last_y) = self.axes
+        u = min(max((datapoint[0] - low_x) * scale_x, 0.0), last_x + 1.0)
+        i = min(int(u), last_x)
+        u -= i
+        v = min(max((datapoint[1] - low_y) * scale_y, 0.0), last_y + 1.0)
+        j = min(int(v), last_y)
+        v -= j
+        values, stride = self.values, self.strides[0]
+        k = i * stride + j
+        a, b = values[k], values[k + 1]
+        c, d = values[k + stride], values[k + stride + 1]
+        return a + (c - a) * u + (b - a + (d - c - b + a) * u) * v
+
+    def trilinear(self, datapoint):
+        (low_x, scale_x, last_x), (low_y, scale_y, last_y), (low_z, scale_z, last_z) = self.axes
+        u = min(max((datapoint[0] - low_x) * scale_x, 0.0), last_x + 1.0)
+        i = min(int(u), last_x)
+        u -= i
+        v = min(max((datapoint[1] - low_y) * scale_y, 0.0), last_y + 1.0)
+        j = min(int(v), last_y)
+        v -= j
+        w = min(max((datapoint[2] - low_z) * scale_z, 0.0), last_z + 1.0)
+        l = min(int(w), last_z)
+        w -= l
+        values, (sx, sy, _) = self.values, self.strides
+        k = i * sx + j * sy + l
+        # Along z on the four edges of the cell, then along y and x
+        a, b = values[k], values[k + sy]
+        c, d = values[k + sx], values[k + sx + sy]
+        a += (values[k + 1] - a) * w
+        b += (values[k + sy + 1] - b) * w
+        c += (values[k + sx + 1] - c) * w
+        d += (values[k + sx + sy + 1] - d) * w
+        a += (b - a) * v
+        c += (d - c) * v
+        return a + (c - a) * u
+
+    def infer_batch(self, X):
+        X = np.asarray(X, dtype=float)
+        lows, highs = np.array(self.lows), np.array(self.highs)
+        resolution = np.array(self.resolution)
+        position = np.clip((X - lows) / (highs - lows), 0, 1) * (resolution - 1)
+        index = np.minimum(position.astype(int), resolution - 2)
+        fraction = position - index
+        flat = self.table.ravel()
+        result = np.zeros(len(X))
+        for corner in self.corners:
+            bits = np.array(corner)
+            weight = np.where(bits, fraction, 1 - fraction).prod(axis=1)
+            result += weight * flat[(index + bits) @ self.strides]
+        return result
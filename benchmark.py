@@ -0,0 +1,506 @@
+"""Timings of the clustering, fuzzy logic and scheduler hot paths.
+
+    python benchmark.py [--quick] [--output results.json] [--compare old.json]
+                        [--plot DIR]
+
+Every benchmark is timed over inputs of growing size. The JSON report holds
+the nested timings and, for each scaling curve, the slope of log(time)
+against log(size): about 1 for linear, 2 for quadratic.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from time import perf_counter
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import cfs
+from cluster import FuzzyKmodes, FuzzyKmodesFuzzyCentroids
+
+with contextlib.redirect_stdout(io.StringIO()):
+    # The notebook export runs its examples on import.
+    from Practise_Assignment_FLS import (Input, LookupTable, Output,
+                                         Reasoner, Rule, Rulebase,
+                                         TriangularMF, priority_reasoner)
+
+
+class Timer:
+    """Nested timing sections, each section keeps its parameters, its best
+    time over `repeat` runs and its child sections."""
+    def __init__(self, name, repeat=3, **params):
+        self.name = name
+        self.repeat = repeat
+        self.params = params
+        self.seconds = 0
+        self.children = []
+
+    @contextlib.contextmanager
+    def section(self, name, **params):
+        child = Timer(name, self.repeat, **params)
+        self.children.append(child)
+        start = perf_counter()
+        yield child
+        child.seconds = perf_counter() - start
+
+    def time(self, name, function, setup=None, **params):
+        best = float('inf')
+        for _ in range(self.repeat):
+            args = setup() if setup else ()
+            start = perf_counter()
+            function(*args)
+            best = min(best, perf_counter() - start)
+        child = Timer(name, self.repeat, **params)
+        child.seconds = best
+        self.children.append(child)
+        return best
+
+    def find(self, name):
+        return [child for child in self.children if child.name == name]
+
+    def to_dict(self):
+        return {'name': self.name, 'params': self.params,
+                'seconds': self.seconds,
+                'children': [child.to_dict() for child in self.children]}
+
+
+def categorical_frame(n, p, levels):
+    rng = np.random.default_rng(n * p * levels)
+    codes = rng.integers(0, levels, size=(n, p))
+    return pd.DataFrame({'a%d' % l: ['t%d' % c for c in codes[:, l]]
+                         for l in range(p)})
+
+
+def bench_cluster(timer, n, k, p, levels):
+    X = categorical_frame(n, p, levels)
+    with timer.section('cluster', n=n, k=k, p=p, levels=levels) as section:
+        model = FuzzyKmodesFuzzyCentroids(X, k=k, n_iter=5, error=0)
+        np.random.seed(0)
+        centroids = model.normalize_centroids(model.random_centroids(), 0)
+        clusters = model.to_clusters(centroids)
+        u = model.memberships(centroids)
+        section.time('fit', lambda: model.fit())
+        section.time('membership', model.memberships, lambda: (centroids,))
+        section.time('update_clusters', model.update_clusters,
+                     lambda: (model.to_clusters(centroids), X, u))
+        section.time('check_normal', model.check_normal,
+                     lambda: (clusters, 0))
+        hard = FuzzyKmodes(X, k=k, n_iter=5, error=0)
+        section.time('FuzzyKmodes.fit', lambda: hard.fit())
+
+
+def bench_pruning(timer, n, p, levels, top_n=10, k=2):
+    X = categorical_frame(n, p, levels)
+    with timer.section('pruning', n=n, p=p, levels=levels,
+                       top_n=top_n) as section:
+        for pruned in (None, top_n):
+            model = FuzzyKmodesFuzzyCentroids(X, k=k, n_iter=5, error=0,
+                                              top_n=pruned)
+            np.random.seed(0)
+            init = model.to_clusters(model.random_centroids())
+            section.time('pruned fit' if pruned else 'fit',
+                         lambda: model.fit(init))
+
+
+def bench_mushrooms(timer, path=os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'Data_fuzzy-shrooms.csv')):
+    df = pd.read_csv(path).dropna()
+    X = df.drop('class', axis=1)
+    y = df['class']
+    with timer.section('mushrooms', n=len(X), p=len(X.columns)) as section:
+        for model in (FuzzyKmodesFuzzyCentroids, FuzzyKmodes):
+            np.random.seed(0)
+            fitted = model(X, y)
+            section.time(model.__name__ + '.fit', lambda: fitted.fit())
+
+
+def fuzzy_system(n_inputs, n_rules, n_points=201):
+    rng = random.Random(n_inputs * n_rules)
+    names = ['Low', 'Medium', 'High']
+
+    def mfs():
+        return [TriangularMF('Low', -50, 0, 50),
+                TriangularMF('Medium', 0, 50, 100),
+                TriangularMF('High', 50, 100, 150)]
+
+    inputs = [Input('x%d' % i, (0, 100), mfs()) for i in range(n_inputs)]
+    output = Output('y', (0, 100), mfs())
+    rules = [Rule(r, [rng.choice(names) for _ in inputs],
+                  rng.choice(['and', 'or']), rng.choice(names))
+             for r in range(n_rules)]
+    return Reasoner(Rulebase(rules), inputs, output, n_points, 'som')
+
+
+def bench_reasoner(timer, n_inputs, n_rules, n_samples=50):
+    reasoner = fuzzy_system(n_inputs, n_rules)
+    rng = np.random.default_rng(0)
+    datapoints = rng.uniform(0, 100, size=(n_samples, n_inputs)).tolist()
+    with timer.section('reasoner', inputs=n_inputs, rules=n_rules,
+                       samples=n_samples) as section:
+        section.time('inference', lambda: [reasoner.inference(datapoint)
+                                           for datapoint in datapoints])
+        section.time('infer_batch', lambda: reasoner.infer_batch(datapoints))
+
+
+def bench_reasoner_cache(timer, n_samples=2000, size=256, precision=1.0):
+    """Inference on a random walk through the inputs, like slowly changing
+    task metrics, with and without the inference cache."""
+    rng = np.random.default_rng(0)
+    datapoints = (50 + np.cumsum(rng.normal(0, 0.1, size=(n_samples, 3)),
+                                 axis=0)).tolist()
+
+    def reasoner(cached):
+        reasoner = fuzzy_system(3, 27)
+        if cached:
+            reasoner.enable_cache(size, precision)
+        return (reasoner,)
+
+    with timer.section('reasoner cache', samples=n_samples, size=size,
+                       precision=precision) as section:
+        for name, cached in (('inference', False), ('cached inference', True)):
+            section.time(name, lambda reasoner: [reasoner.inference(datapoint)
+                                                 for datapoint in datapoints],
+                         lambda: reasoner(cached))
+        cached, = reasoner(True)
+        for datapoint in datapoints:
+            cached.inference(datapoint)
+        section.children[-1].params = cached.cache_info()
+
+
+def task_dicts(n):
+    rng = random.Random(n)
+    return [{'label': 'task %d' % i, 'nice': rng.randint(-20, 19),
+             'time': rng.randint(1, 90), 'number': i} for i in range(n)]
+
+
+def bench_scheduler(timer, n):
+    tasks = task_dicts(n)
+    weighting = cfs.FuzzyWeights(priority_reasoner())
+    table = cfs.FuzzyWeights(LookupTable(priority_reasoner(), 9, samples=0))
+
+    def empty_tree():
+        return (cfs.ProcessTree({'stats': {'done': 0}, 'tasks': []}),)
+
+    def full_tree():
+        tree, = empty_tree()
+        tree.add_tasks(tasks)
+        return (tree,)
+
+    def fuzzy_tree(weighting=weighting):
+        tree, = full_tree()
+        tree.weighting = weighting
+        # Paused tasks have no start_time left, the wait feature must
+        # still be defined for them.
+        for task in list(tree.tree.values())[::2]:
+            tree.start_task(task)
+            tree.pause_task(task)
+        return (tree,)
+
+    with timer.section('scheduler', tasks=n) as section:
+        section.time('add_tasks', lambda tree: tree.add_tasks(tasks),
+                     empty_tree)
+        section.time('weigh', lambda tree: tree.weigh(), full_tree)
+        section.time('fuzzy reweigh', lambda tree: tree.reweigh(),
+                     fuzzy_tree)
+        section.time('table reweigh', lambda tree: tree.reweigh(),
+                     lambda: fuzzy_tree(table))
+
+
+def bench_shares(timer, slices=10000, nices=(-5, 5)):
+    """Two tasks share one cpu, each should run in proportion to its
+    weight, through ProcessTree.account() and through a one-cpu
+    Scheduler."""
+    expected = cfs.nice_weight(nices[0]) / cfs.nice_weight(nices[1])
+
+    def tree_slices():
+        tree = cfs.ProcessTree()
+        tree.add_tasks([{'nice': nice, 'number': nice} for nice in nices])
+        ran = Counter()
+        for _ in range(slices):
+            task = tree.pick_next()
+            tree.account(task, 0.001)
+            ran[task.nice] += 1
+        return ran
+
+    def scheduler_slices():
+        scheduler = cfs.Scheduler(cpus=1)
+        for nice in nices:
+            scheduler.enqueue({'nice': nice, 'number': nice}, 0)
+        ran = Counter()
+        for _ in range(slices):
+            task = scheduler.dequeue(0)
+            scheduler.requeue(0, task, 0.001)
+            ran[task.nice] += 1
+        return ran
+
+    with timer.section('shares', slices=slices) as section:
+        for name, run_slices in (('account', tree_slices),
+                                 ('scheduler requeue', scheduler_slices)):
+            shares = []
+            section.time(name, lambda: shares.append(run_slices()))
+            ran = shares[-1]
+            ratio = ran[nices[0]] / ran[nices[1]]
+            section.children[-1].params = {'ratio': ratio,
+                                           'expected': expected}
+            if abs(ratio / expected - 1) > 0.02:
+                raise AssertionError('%s: nice %d ran %.2fx as often as '
+                                     'nice %d, the weights say %.2fx' % (
+                                         name, nices[0], ratio, nices[1],
+                                         expected))
+
+
+def bench_cpus(timer, cpus, n=2000):
+    """Each cpu has a thread that enqueues n tasks and runs them once, so
+    with perfect scaling the time stays flat as cpus grow."""
+    tasks = task_dicts(n)
+
+    def workload():
+        scheduler = cfs.Scheduler(cpus)
+
+        def worker(cpu):
+            for task in tasks:
+                scheduler.enqueue(dict(task), cpu)
+                task = scheduler.dequeue(cpu)
+                if task is not None:
+                    scheduler.requeue(cpu, task, 0.001)
+        threads = [threading.Thread(target=worker, args=(cpu,))
+                   for cpu in range(cpus)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    with timer.section('scheduler', cpus=cpus, tasks=n) as section:
+        section.time('per-cpu queues', workload)
+
+
+def spin(task):
+    """A slice of pure Python work, a task is done after time / 30."""
+    for _ in range(2000):
+        pass
+    task.time -= 30
+    return task.time <= 0
+
+
+def bench_processes(timer, cpus, n=2000):
+    """n tasks of a few slices of spin() per cpu on a ProcessScheduler,
+    with a core per cpu the time stays flat as cpus grow."""
+    tasks = task_dicts(n * cpus)
+    with timer.section('scheduler', cpus=cpus, tasks=n) as section:
+        section.time('per-cpu processes',
+                     lambda: cfs.ProcessScheduler(cpus).run(tasks, spin))
+
+
+def bench_executor(timer, n, steps=4):
+    """n generator tasks of a few empty steps each, so the run is nearly
+    all dispatch overhead."""
+    def work():
+        for _ in range(steps):
+            yield
+
+    executors = []
+
+    def setup(instrument=False):
+        executor = cfs.Executor(period=1e-5, min_slice=0)
+        if instrument:
+            executor.tree.instrument()
+        for task in task_dicts(n):
+            executor.submit(work, **task)
+        executors.append(executor)
+        return (executor,)
+
+    with timer.section('executor', tasks=n) as section:
+        plain = section.time('run',
+                             lambda executor: asyncio.run(executor.run()),
+                             setup)
+        report = executors[-1].report()
+        section.children[-1].params = {
+            'dispatches': report['dispatches'],
+            'overhead_per_dispatch': report['overhead_per_dispatch'],
+            'latency_p99': report['latency_p99']}
+        instrumented = section.time(
+            'instrumented run', lambda executor: asyncio.run(executor.run()),
+            lambda: setup(True))
+        section.children[-1].params = {
+            'overhead': instrumented / plain - 1}
+
+
+def bench_task_memory(timer, n=100000):
+    tasks = task_dicts(n)
+    makers = (('Task', lambda task: cfs.Task(**task)),
+              ('ColumnTask', lambda task: cfs.ColumnTask(store, **task)))
+    with timer.section('task memory', tasks=n) as section:
+        for name, make in makers:
+            store = cfs.TaskStore()
+            tracemalloc.start()
+            made = [make(task) for task in tasks]
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del made
+            section.children.append(Timer(name, bytes_per_task=used / n))
+
+
+def scaling(timer, group, function, parameter):
+    """Seconds of `function` in the `group` sections against `parameter`,
+    with the log-log slope of the curve."""
+    xs, seconds = [], []
+    for section in timer.find(group):
+        timed = section.find(function)
+        if timed and parameter in section.params:
+            xs.append(section.params[parameter])
+            seconds.append(timed[0].seconds)
+    slope = None
+    if len(set(xs)) > 1:
+        slope = float(np.polyfit(np.log(xs), np.log(np.maximum(seconds,
+                                                                1e-9)), 1)[0])
+    return {'group': group, 'function': function, 'parameter': parameter,
+            'x': xs, 'seconds': seconds, 'slope': slope}
+
+
+def run(quick=False, repeat=3):
+    scale = 1 if quick else 4
+    ns = [500 * scale * 2 ** i for i in range(4)]
+    ks = [2, 4, 8, 16]
+    root = Timer('benchmark', repeat)
+    curves = []
+    start = perf_counter()
+
+    with root.section('vs n') as section:
+        for n in ns:
+            bench_cluster(section, n, 2, 10, 5)
+    curves += [scaling(section, 'cluster', function, 'n') for function in
+               ('fit', 'membership', 'update_clusters', 'check_normal',
+                'FuzzyKmodes.fit')]
+
+    with root.section('vs k') as section:
+        for k in ks:
+            bench_cluster(section, ns[0], k, 10, 5)
+    curves += [scaling(section, 'cluster', function, 'k') for function in
+               ('fit', 'membership', 'update_clusters')]
+
+    with root.section('vs attributes') as section:
+        for p in [5, 10, 20, 40]:
+            bench_cluster(section, ns[0], 2, p, 5)
+    curves.append(scaling(section, 'cluster', 'fit', 'p'))
+
+    with root.section('vs levels') as section:
+        for levels in [4, 16, 64, 256]:
+            bench_cluster(section, ns[0], 2, 10, levels)
+    curves += [scaling(section, 'cluster', function, 'levels') for function
+               in ('fit', 'check_normal')]
+    bench_pruning(root, 5000 * scale, 5, 500 * scale)
+
+    with root.section('vs rules') as section:
+        for rules in [9, 27, 81, 243]:
+            bench_reasoner(section, 3, rules)
+    curves += [scaling(section, 'reasoner', function, 'rules') for function
+               in ('inference', 'infer_batch')]
+
+    with root.section('vs inputs') as section:
+        for inputs in [2, 4, 8]:
+            bench_reasoner(section, inputs, 27)
+    curves += [scaling(section, 'reasoner', function, 'inputs') for function
+               in ('inference', 'infer_batch')]
+    bench_reasoner_cache(root)
+
+    with root.section('vs tasks') as section:
+        for n in [100 * scale * 2 ** i for i in range(4)]:
+            bench_scheduler(section, n)
+    curves += [scaling(section, 'scheduler', function, 'tasks') for function
+               in ('add_tasks', 'weigh', 'fuzzy reweigh', 'table reweigh')]
+
+    bench_shares(root)
+
+    with root.section('vs cpus') as section:
+        for cpus in [1, 2, 4, 8]:
+            bench_cpus(section, cpus, 500 * scale)
+    curves.append(scaling(section, 'scheduler', 'per-cpu queues', 'cpus'))
+
+    with root.section('vs processes') as section:
+        for cpus in [1, 2, 4, 8]:
+            bench_processes(section, cpus, 500 * scale)
+    curves.append(scaling(section, 'scheduler', 'per-cpu processes', 'cpus'))
+
+    with root.section('vs executor tasks') as section:
+        for n in [250 * scale * 2 ** i for i in range(4)]:
+            bench_executor(section, n)
+    curves.append(scaling(section, 'executor', 'run', 'tasks'))
+
+    bench_task_memory(root, 10000 * scale)
+    bench_mushrooms(root)
+    root.seconds = perf_counter() - start
+    return {'timings': root.to_dict(), 'scaling': curves}
+
+
+def flatten(timing, path=()):
+    path = path + (timing['name'] + ''.join(
+        ' %s=%s' % item for item in sorted(timing['params'].items())),)
+    yield ' / '.join(path), timing['seconds']
+    for child in timing['children']:
+        yield from flatten(child, path)
+
+
+def report(results, baseline=None):
+    old = dict(flatten(baseline['timings'])) if baseline else {}
+    for name, seconds in flatten(results['timings']):
+        line = '%10.6f  %s' % (seconds, name)
+        if old.get(name):
+            line += '  (x%.2f)' % (seconds / old[name])
+        print(line)
+    print()
+    for curve in results['scaling']:
+        slope = 'n/a' if curve['slope'] is None else '%.2f' % curve['slope']
+        print('%-10s %-17s vs %-7s slope %s' % (
+            curve['group'], curve['function'], curve['parameter'], slope))
+
+
+def plot(results, directory):
+    for curve in results['scaling']:
+        plt.figure()
+        plt.loglog(curve['x'], curve['seconds'], marker='o')
+        plt.xlabel(curve['parameter'])
+        plt.ylabel('seconds')
+        plt.title('%s %s' % (curve['group'], curve['function']))
+        plt.savefig('%s/%s_%s_%s.png' % (directory, curve['group'],
+                                         curve['function'],
+                                         curve['parameter']))
+        plt.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller inputs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='best of this many runs per timing')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--plot', help='save the scaling curves here')
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fle:
+            baseline = json.load(fle)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as fle:
+            json.dump(results, fle, indent=2)
+    if args.plot:
+        plot(results, args.plot)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
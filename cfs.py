@@ -1,108 +1,1266 @@
-from time import time
+from collections import Counter, defaultdict, deque
+from itertools import count, islice
+from datetime import datetime
+from time import perf_counter, time
+import asyncio
 import bintrees
+import inspect
 import json
+import multiprocessing
+import numpy as np
 import getopt
+import os
+import queue
 import sys
+import threading
 
 tasks = []
 time_slice = 45
 num_timeslices = 8
 tree = bintrees.RBTree()
 exit = False
+nice_0_weight = 1024
+gram_size = 3
 
 
 class ProcessTree:
-    def __init__(self, tasks=None):
+    def __init__(self, tasks=None, store=None, weighting=None):
+        # A CFS run queue: keys are (vruntime, id) so the leftmost task is
+        # the one that should run next, it is cached to pick it in O(1).
+        # total_weight is kept up to date on every insert and removal so a
+        # task's share is available without a pass over the tree.
         self.tree = bintrees.RBTree()
-        self.stats = tasks.get('stats')
+        self.leftmost = None
+        self.min_vruntime = 0
+        self.total_weight = 0
+        self.next_id = 0
+        # Secondary indexes, maintained by index() and unindex().
+        self.by_id = {}
+        self.numbers = defaultdict(set)
+        self.labels = defaultdict(set)
+        self.grams = defaultdict(set)
+        self.journal = None
+        self.metrics = None
+        # With a TaskStore the numeric fields of the tasks are kept in its
+        # columns, which reweigh() and summary() work on in bulk.
+        self.store = store
+        # With a weighting, e.g. FuzzyWeights, reweigh() asks it for the
+        # weights of all tasks instead of deriving them from nice alone.
+        self.weighting = weighting
+        self.stats = tasks.get('stats') if tasks else {'done': 0}
         if tasks:
             self.add_tasks(tasks['tasks'])
 
-    def task_weight(self, task, tasks):
-        return task.weight / sum(task.weight for task in tasks)
+    def task_weight(self, task, tasks=None):
+        if tasks is not None:
+            return task.weight / sum(task.weight for task in tasks)
+        return task.weight / self.total_weight
+
+    def key(self, task):
+        return (task.vruntime, task.id)
+
+    def insert(self, task):
+        if task.id is None:
+            task.id = self.next_id
+        self.next_id = max(self.next_id, task.id + 1)
+        key = self.key(task)
+        self.tree.insert(key, task)
+        self.total_weight += task.weight
+        if self.leftmost is None or key < self.leftmost[0]:
+            self.leftmost = (key, task)
+
+    def discard(self, task):
+        key = self.key(task)
+        self.tree.remove(key)
+        self.total_weight -= task.weight
+        if self.leftmost[0] == key:
+            self.leftmost = self.tree.min_item() if self.tree else None
+
+    def update_min_vruntime(self):
+        # Only moves forward. It is updated after a requeued task is back
+        # in the tree, so the task that just ran counts like the running
+        # task does in CFS.
+        if self.leftmost is not None:
+            self.min_vruntime = max(self.min_vruntime, self.leftmost[0][0])
+
+    def pick_next(self):
+        if self.leftmost is None:
+            return None
+        return self.leftmost[1]
+
+    def account(self, task, elapsed, now=None):
+        # Requeue the task with its vruntime advanced by the time it ran,
+        # scaled so heavier (lower nice) tasks advance slower.
+        self.requeue(task,
+                     task.vruntime + elapsed * nice_0_weight / task.weight)
+        task.runnable_at = time()
+        if self.metrics is not None and task.id % self.metrics.every == 0:
+            self.metrics.ran(task, elapsed, now)
+
+    def requeue(self, task, vruntime):
+        self.discard(task)
+        task.vruntime = vruntime
+        self.insert(task)
+        self.update_min_vruntime()
+        self.log('requeue', id=task.id, vruntime=task.vruntime)
+
+    def instrument(self, depth_samples=1024, depth_every=16, every=16):
+        """Start recording Metrics of the queue, see Metrics."""
+        self.metrics = Metrics(depth_samples, depth_every, every=every)
+        for task in self.tree.values():
+            if task.id % every == 0:
+                self.metrics.runnable(task, len(self.tree))
+        return self.metrics
 
     def add_tasks(self, task_dicts):
         if type(task_dicts) == dict:
-            tasks = [Task(**task_dicts)]
+            task_dicts = [task_dicts]
+        if self.store is not None:
+            tasks = [ColumnTask(self.store, **task) for task in task_dicts]
         else:
             tasks = [Task(**task) for task in task_dicts]
 
         for task in tasks:
-            self.tree.insert(task.weight, task)
-        self.weigh()
+            self.enqueue(task)
+
+    def enqueue(self, task, now=None, wakeup=True):
+        if self.store is not None and task.row is None:
+            self.store.attach(task)
+        if task.runnable_at is None or not wakeup:
+            task.runnable_at = time()
+        if wakeup:
+            # New and woken up tasks start at the queue's minimum so they
+            # can not monopolize the cpu with a vruntime far behind the
+            # others. A task put back after its slice keeps its vruntime.
+            task.vruntime = max(task.vruntime, self.min_vruntime)
+        self.insert(task)
+        self.update_min_vruntime()
+        self.index(task)
+        self.log('add', task=task.to_dict())
+        if self.metrics is not None and task.id % self.metrics.every == 0:
+            self.metrics.runnable(task, len(self.tree), now)
+
+    def pop_next(self):
+        task = self.pick_next()
+        if task is not None:
+            self.remove_task((self.key(task), task))
+        return task
+
+    def index(self, task):
+        self.by_id[task.id] = task
+        self.numbers[task.number].add(task.id)
+        self.labels[task.label].add(task.id)
+        for gram in label_grams(task.label):
+            self.grams[gram].add(task.id)
+
+    def unindex(self, task):
+        del self.by_id[task.id]
+        if self.store is not None:
+            self.store.release(task)
+        remove_from(self.numbers, task.number, task.id)
+        remove_from(self.labels, task.label, task.id)
+        for gram in label_grams(task.label):
+            remove_from(self.grams, gram, task.id)
 
     def weigh(self):
-        tasks = self.tree.values()
-        for task in tasks:
-            task.weight = self.task_weight(task, tasks)
-            # time = task.time * task.weight
-            self.tree.insert(task.weight, task)
+        # Recompute the running total from scratch, mutations keep it
+        # up to date so this is only needed to correct rounding drift.
+        if self.store is not None:
+            self.total_weight = self.store.weight[self.store.used].sum()
+        else:
+            self.total_weight = sum(task.weight for task in self.tree.values())
+
+    def reweigh(self):
+        """Set the weight of every task from its nice level again, or from
+        the weighting of the tree if it has one."""
+        if self.weighting is not None:
+            tasks = list(self.tree.values())
+            weights = self.weighting.weights(self, tasks)
+            if self.store is not None:
+                self.store.weight[[task.row for task in tasks]] = weights
+            else:
+                for task, weight in zip(tasks, weights.tolist()):
+                    task.weight = weight
+            # The weighting depends on the time, so replay needs the
+            # weights themselves.
+            self.log('reweigh', weights=[[task.id, weight] for task, weight
+                                         in zip(tasks, weights.tolist())])
+        else:
+            if self.store is not None:
+                self.store.reweigh()
+            else:
+                for task in self.tree.values():
+                    task.weight = nice_weight(task.nice)
+            self.log('reweigh')
+        self.weigh()
+        if self.metrics is not None:
+            self.metrics.weigh(self)
+
+    def summary(self):
+        if not len(self.tree):
+            return {'tasks': 0}
+        if self.store is not None:
+            columns = {name: getattr(self.store, name)[self.store.used]
+                       for name in TaskStore.columns}
+        else:
+            tasks = list(self.tree.values())
+            columns = {name: np.array([getattr(task, name) for task in tasks])
+                       for name in TaskStore.columns}
+        return {'tasks': len(self.tree),
+                'total_weight': columns['weight'].sum(),
+                'max_share': columns['weight'].max() / self.total_weight,
+                'min_vruntime': columns['vruntime'].min(),
+                'max_vruntime': columns['vruntime'].max(),
+                'mean_time': columns['time'].mean(),
+                'nice_levels': len(np.unique(columns['nice']))}
+
+    def renice(self, task, nice):
+        sampled = (self.metrics is not None and
+                   task.id % self.metrics.every == 0)
+        if sampled:
+            self.metrics.add_weight(task.nice, -task.weight)
+        self.total_weight -= task.weight
+        task.nice = int(nice)
+        task.weight = nice_weight(task.nice)
+        self.total_weight += task.weight
+        self.log('renice', id=task.id, nice=task.nice)
+        if sampled:
+            self.metrics.add_weight(task.nice, task.weight)
 
     def by_label(self, label):
-        tasks = [(key, task) for key, task in self.tree.items() if label in task.label]
+        """The first task in run queue order whose label contains `label`,
+        as a (key, task) pair."""
+        if len(label) >= gram_size:
+            # Only tasks having every n-gram of the label can contain it.
+            grams = [self.grams.get(gram, set())
+                     for gram in label_grams(label)]
+            ids = set.intersection(*sorted(grams, key=len))
+        else:
+            ids = (id for text, ids in self.grams.items() if label in text
+                   for id in ids)
+        tasks = [self.by_id[id] for id in ids]
+        tasks = [(self.key(task), task) for task in tasks
+                 if label in task.label]
         if tasks:
-            return tasks[0]
+            return min(tasks, key=lambda item: item[0])
         return None
 
+    def with_label(self, label):
+        return [self.by_id[id] for id in self.labels.get(label, ())]
+
+    def with_number(self, number):
+        return [self.by_id[id] for id in self.numbers.get(number, ())]
+
+    def state(self):
+        return {"stats": self.stats,
+                "tasks": [task.to_dict() for task in self.tree.values()],
+                "next_id": self.next_id,
+                "min_vruntime": self.min_vruntime,
+                "seq": self.journal.seq if self.journal else 0}
+
     def save(self, path):
-        towrite = {"stats": self.stats,
-                    "tasks": [dict(vars(task)) for task in self.tree.values()]
-                   }
+        if self.journal and self.journal.path == path:
+            # Every change is already in the journal.
+            self.journal.flush()
+            return
         with open(path, 'w') as fle:
-            fle.write(json.dumps(towrite))
+            fle.write(json.dumps(self.state()))
 
-    def remove_task(self, task):
-        self.tree.remove(task[0])
-        self.weigh()
+    @classmethod
+    def open(cls, path, snapshot_every=1000, sync=False):
+        """Load the tree from the snapshot at `path` and the journal next
+        to it, and journal every later change."""
+        state = None
+        if os.path.exists(path):
+            with open(path) as fle:
+                state = json.load(fle)
+        tree = cls(state)
+        seq = 0
+        if state:
+            tree.next_id = max(tree.next_id, state.get('next_id', 0))
+            tree.min_vruntime = state.get('min_vruntime', 0)
+            seq = state.get('seq', 0)
+        for record in Journal.read(path):
+            # Records up to the snapshot's seq are already in it.
+            if record['seq'] > seq:
+                tree.replay(record)
+                seq = record['seq']
+        tree.journal = Journal(path, seq, snapshot_every, sync)
+        return tree
+
+    def log(self, op, **record):
+        if self.journal:
+            self.journal.append(op, record)
+            if self.journal.records >= self.journal.snapshot_every:
+                self.journal.snapshot(self)
 
-    def start_task(self, task):
-        task.start_time = time()
+    def replay(self, record):
+        op = record['op']
+        if op == 'add':
+            self.add_tasks(record['task'])
+            return
+        if op == 'reweigh':
+            if 'weights' in record:
+                for id, weight in record['weights']:
+                    self.by_id[id].weight = weight
+                self.weigh()
+            else:
+                self.reweigh()
+            return
+        task = self.by_id[record['id']]
+        if op == 'remove':
+            self.remove_task((self.key(task), task))
+        elif op == 'start':
+            task.start_time = task.last_start = record['start_time']
+            task.runnable_at = None
+        elif op == 'pause':
+            task.time = record['time']
+            if hasattr(task, 'start_time'):
+                del(task.start_time)
+        elif op == 'requeue':
+            self.requeue(task, record['vruntime'])
+        elif op == 'renice':
+            self.renice(task, record['nice'])
+
+    def remove_task(self, task, now=None):
+        self.discard(task[1])
+        self.update_min_vruntime()
+        self.unindex(task[1])
+        self.log('remove', id=task[1].id)
+        if self.metrics is not None and task[1].id % self.metrics.every == 0:
+            self.metrics.removed(task[1], len(self.tree), now)
+
+    def start_task(self, task, now=None):
+        # `now` is the perf_counter() time for the metrics, start_time is
+        # wall clock time.
+        task.start_time = task.last_start = time()
+        task.runnable_at = None
+        self.log('start', id=task.id, start_time=task.start_time)
+        if self.metrics is not None and task.id % self.metrics.every == 0:
+            self.metrics.started(task, now)
 
     def pause_task(self, task):
         if not task.paused:
-            task.time = (time() - task.start_time) / 60
+            elapsed = time() - task.start_time
+            task.time = elapsed / 60
             del(task.start_time)
-            self.weigh()
+            self.log('pause', id=task.id, time=task.time)
+            self.account(task, elapsed)
         else:
             print('Task:', task, 'is not paused at the moment')
 
     def __repr__(self):
         total = 0
         print(self.stats['done'])
-        for weight, task in self.tree.items():
+        for task in self.tree.values():
+            weight = self.task_weight(task)
             total += weight
             print(weight, task)
 
         return str(total)
 
     def __getitem__(self, name):
-        return self.tree[name]
+        if isinstance(name, tuple):
+            return self.tree[name]
+        return self.by_id[name]
+
+
+class FuzzyWeights:
+    """Task weights from a fuzzy rulebase instead of from nice alone.
+
+    `reasoner` is a Mamdani Reasoner, see Practise_Assignment_FLS.py and
+    its priority_reasoner(), or a LookupTable of one, which interpolates
+    its outputs from a grid instead of inferring them. Its inputs are
+    matched to task features by name:
+
+    - nice: the nice level
+    - runtime: seconds the task's vruntime is ahead of the queue minimum
+    - wait: seconds since the task became runnable, when it was added or
+      put back after its last slice, 0 while it runs
+    - due: seconds until the task's due date, the top of the range if it
+      has none
+
+    and its output is an effective nice level, turned into a weight like
+    nice is. Inputs are clipped to their variable's range and the whole
+    queue goes through the reasoner's infer_batch() at once, defuzzified
+    as the reasoner is set up.
+    """
+    features = {
+        'nice': lambda tree, task, now: task.nice,
+        'runtime': lambda tree, task, now: task.vruntime - tree.min_vruntime,
+        'wait': lambda tree, task, now:
+            now - task.runnable_at if task.runnable_at is not None else 0.0,
+        'due': lambda tree, task, now:
+            task.due_date - now if task.due_date is not None else np.inf,
+    }
+
+    def __init__(self, reasoner):
+        self.reasoner = reasoner
+        self.lows = np.array([variable.range[0]
+                              for variable in reasoner.inputs], dtype=float)
+        self.highs = np.array([variable.range[1]
+                               for variable in reasoner.inputs], dtype=float)
+
+    def values(self, tree, tasks, now=None):
+        now = time() if now is None else now
+        X = np.empty((len(tasks), len(self.reasoner.inputs)))
+        for i, variable in enumerate(self.reasoner.inputs):
+            feature = self.features[variable.name]
+            X[:, i] = [feature(tree, task, now) for task in tasks]
+        return X
+
+    def infer(self, X):
+        """The crisp output of the reasoner for every row of X."""
+        return self.reasoner.infer_batch(np.clip(X, self.lows, self.highs))
+
+    def weights(self, tree, tasks, now=None):
+        if not tasks:
+            return np.zeros(0)
+        return nice_0_weight / 1.25**self.infer(self.values(tree, tasks,
+                                                            now))
+
+
+class Journal:
+    """Append-only log of the changes to a ProcessTree, next to a snapshot
+    of the whole tree at `path`.
+
+    Every record is flushed to the OS as it is written (and fsynced with
+    sync=True), so a crash loses at most the record being written. After
+    snapshot_every records the tree is written to a new snapshot and the
+    journal starts over. Records carry a sequence number so the ones
+    already in a snapshot are skipped when a crash left them behind.
+    """
+    def __init__(self, path, seq=0, snapshot_every=1000, sync=False):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.seq = seq
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self.records = 0
+        self.repair()
+        self.fle = open(self.journal_path, 'a')
+
+    def repair(self):
+        # Drop a record cut off by a crash so new ones start on their own
+        # line.
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb+') as fle:
+            fle.truncate(fle.read().rfind(b'\n') + 1)
+
+    def append(self, op, record):
+        self.seq += 1
+        record['seq'] = self.seq
+        record['op'] = op
+        self.fle.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.flush()
+        self.records += 1
+
+    def flush(self):
+        self.fle.flush()
+        if self.sync:
+            os.fsync(self.fle.fileno())
+
+    def snapshot(self, tree):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as fle:
+            fle.write(json.dumps(tree.state()))
+            fle.flush()
+            os.fsync(fle.fileno())
+        os.replace(temporary, self.path)
+        self.fle.close()
+        self.fle = open(self.journal_path, 'w')
+        self.records = 0
+
+    def close(self):
+        self.fle.close()
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path + '.journal'):
+            return
+        with open(path + '.journal') as fle:
+            for line in fle:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # A record cut off by a crash, nothing follows it.
+                    return
+
+
+class Histogram:
+    """Log-linear histogram in the style of HdrHistogram: every power of two
+    is split in sub_buckets linear buckets, so a bucket's bounds are within
+    1 / sub_buckets of each other relative to the value.
+
+    Values are appended to a buffer and binned with NumPy once it holds
+    `buffer` values, which keeps record() down to a list append.
+    """
+    def __init__(self, sub_buckets=64, min_exponent=-32, max_exponent=32,
+                 buffer=4096):
+        self.sub_buckets = sub_buckets
+        self.min_exponent = min_exponent
+        self.max_exponent = max_exponent
+        self.buffer = buffer
+        self.counts = np.zeros((max_exponent - min_exponent) * sub_buckets,
+                               dtype=np.int64)
+        self.zeros = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+        self.pending = []
+
+    def record(self, value):
+        self.pending.append(value)
+        if len(self.pending) >= self.buffer:
+            self.flush()
+
+    def record_many(self, values):
+        self.flush()
+        self.bin(np.asarray(values, dtype=float))
+
+    def flush(self):
+        if not self.pending:
+            return
+        values = np.array(self.pending, dtype=float)
+        self.pending = []
+        self.bin(values)
+
+    def bin(self, values):
+        self.sum += values.sum()
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        mantissa, exponent = np.frexp(positive)
+        exponent = np.clip(exponent, self.min_exponent,
+                           self.max_exponent - 1) - self.min_exponent
+        sub = ((mantissa * 2 - 1) * self.sub_buckets).astype(int)
+        self.counts += np.bincount(exponent * self.sub_buckets + sub,
+                                   minlength=len(self.counts))
+
+    @property
+    def count(self):
+        self.flush()
+        return self.zeros + int(self.counts.sum())
+
+    def upper_bound(self, index):
+        exponent, sub = divmod(index, self.sub_buckets)
+        return 2.0 ** (exponent + self.min_exponent) * \
+            (0.5 + (sub + 1) / (2 * self.sub_buckets))
+
+    def percentile(self, q):
+        count = self.count
+        if not count:
+            return None
+        rank = q / 100 * count
+        if rank <= self.zeros:
+            return 0.0
+        index = np.searchsorted(np.cumsum(self.counts), rank - self.zeros)
+        return float(min(self.upper_bound(index), self.max))
+
+    def buckets(self):
+        """(upper bound, cumulative count) of the non-empty buckets."""
+        self.flush()
+        cumulative = np.cumsum(self.counts) + self.zeros
+        return [(self.upper_bound(index), int(cumulative[index]))
+                for index in np.flatnonzero(self.counts)]
+
+    def to_dict(self):
+        count = self.count
+        if not count:
+            return {'count': 0}
+        return {'count': count, 'sum': float(self.sum),
+                'min': float(self.min), 'max': float(self.max),
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99), 'p999': self.percentile(99.9)}
+
+
+class Metrics:
+    """What a ProcessTree records once instrumented:
+
+    - wait: seconds from runnable (added or requeued) until started, in
+      total and per nice level
+    - slice: seconds a task ran before it was requeued
+    - preemptions: requeues of each task, binned when the task is removed
+    - depth: run queue length after every depth_every-th add or removal
+      of a followed task, as a histogram and the last depth_samples (time, depth) pairs
+    - fairness(): per nice level, the share of the run time the level got
+      minus the share it was due, its weight over the total weight of the
+      queue summed over every slice
+
+    Only the tasks whose id is a multiple of `every` are followed, which
+    keeps the cost of the hooks under 2% of a dispatch of the Executor.
+    Their waits, slices and preemptions are all recorded, and fairness()
+    compares them to each other: their weight over the total weight of
+    the followed tasks, summed over their slices. every=1 follows all
+    tasks, as small queues need.
+
+    The hooks take the perf_counter() time of the event from callers that
+    already have it, e.g. Executor.run(), and read the clock otherwise.
+    Waits, slices and removals are appended to lists and binned by flush()
+    once `buffer` of them are pending and before every report, call it
+    before reading the histograms or counters directly.
+    """
+    def __init__(self, depth_samples=1024, depth_every=16, buffer=4096,
+                 every=16):
+        self.every = every
+        self.wait = Histogram()
+        self.wait_by_nice = defaultdict(Histogram)
+        self.slice = Histogram()
+        self.preemptions = Histogram()
+        self.preempted = Counter()
+        self.total_preemptions = 0
+        self.depth = Histogram()
+        self.depth_samples = deque(maxlen=depth_samples)
+        self.depth_every = depth_every
+        self.mutations = 0
+        self.buffer = buffer
+        self.waits = []
+        self.wait_nices = []
+        self.slices = []
+        self.slice_nices = []
+        self.slice_ids = []
+        self.removed_ids = []
+        self.runnable_since = {}
+        self.runtime_by_nice = defaultdict(float)
+        # A level's due run time grows by its weight times the slices
+        # divided by the total weight, `clock` sums the latter so a slice
+        # costs O(1) and a level only settles when its weight changes.
+        self.clock = 0.0
+        self.total_weight = 0.0
+        self.weight_by_nice = defaultdict(float)
+        self.due_by_nice = defaultdict(float)
+        self.settled = {}
+
+    def runnable(self, task, depth, now=None):
+        if now is None:
+            now = perf_counter()
+        self.runnable_since[task.id] = now
+        self.add_weight(task.nice, task.weight)
+        self.mutations += 1
+        if self.mutations % self.depth_every == 0:
+            self.sample_depth(depth, now)
+
+    def started(self, task, now=None):
+        since = self.runnable_since.pop(task.id, None)
+        if since is not None:
+            self.waits.append((perf_counter() if now is None else now) - since)
+            self.wait_nices.append(task.nice)
+
+    def ran(self, task, elapsed, now=None):
+        self.runnable_since[task.id] = perf_counter() if now is None else now
+        self.slices.append(elapsed)
+        self.slice_nices.append(task.nice)
+        self.slice_ids.append(task.id)
+        if self.total_weight > 0:
+            self.clock += elapsed / self.total_weight
+        if len(self.slices) >= self.buffer:
+            self.flush()
+
+    def flush(self):
+        """Bin the waits, slices and removals since the last flush."""
+        if self.waits:
+            waits, nices = np.array(self.waits), np.array(self.wait_nices)
+            self.waits, self.wait_nices = [], []
+            self.wait.record_many(waits)
+            for nice in np.unique(nices).tolist():
+                self.wait_by_nice[nice].record_many(waits[nices == nice])
+        if self.slices:
+            slices, nices = np.array(self.slices), np.array(self.slice_nices)
+            ids, counts = np.unique(self.slice_ids, return_counts=True)
+            self.slices, self.slice_nices, self.slice_ids = [], [], []
+            self.slice.record_many(slices)
+            self.total_preemptions += len(slices)
+            for nice in np.unique(nices).tolist():
+                self.runtime_by_nice[nice] += float(slices[nices == nice].sum())
+            self.preempted.update(dict(zip(ids.tolist(), counts.tolist())))
+        for id in self.removed_ids:
+            self.preemptions.record(self.preempted.pop(id, 0))
+        self.removed_ids = []
+
+    def removed(self, task, depth, now=None):
+        self.runnable_since.pop(task.id, None)
+        self.removed_ids.append(task.id)
+        if len(self.waits) >= self.buffer:
+            self.flush()
+        self.add_weight(task.nice, -task.weight)
+        self.mutations += 1
+        if self.mutations % self.depth_every == 0:
+            self.sample_depth(depth, perf_counter() if now is None else now)
+
+    def sample_depth(self, depth, now):
+        self.depth.record(depth)
+        self.depth_samples.append((now, depth))
 
+    def add_weight(self, nice, weight):
+        self.settle(nice)
+        self.weight_by_nice[nice] += weight
+        self.total_weight += weight
+
+    def settle(self, nice):
+        self.due_by_nice[nice] += self.weight_by_nice[nice] * (
+            self.clock - self.settled.get(nice, self.clock))
+        self.settled[nice] = self.clock
+
+    def weigh(self, tree):
+        for nice in self.weight_by_nice:
+            self.settle(nice)
+        self.weight_by_nice.clear()
+        for task in tree.tree.values():
+            if task.id % self.every == 0:
+                self.weight_by_nice[task.nice] += task.weight
+        self.total_weight = sum(self.weight_by_nice.values())
+
+    def fairness(self):
+        self.flush()
+        for nice in list(self.weight_by_nice):
+            self.settle(nice)
+        runtime = sum(self.runtime_by_nice.values())
+        if not runtime:
+            return {}
+        return {nice: (self.runtime_by_nice[nice] - self.due_by_nice[nice])
+                / runtime for nice in sorted(self.due_by_nice)}
+
+    def to_dict(self):
+        self.flush()
+        return {'wait': self.wait.to_dict(),
+                'wait_by_nice': {nice: histogram.to_dict() for nice, histogram
+                                 in sorted(self.wait_by_nice.items())},
+                'slice': self.slice.to_dict(),
+                'preemptions': self.total_preemptions,
+                'preemptions_per_task': self.preemptions.to_dict(),
+                'depth': self.depth.to_dict(),
+                'depth_samples': list(self.depth_samples),
+                'fairness': self.fairness()}
+
+    def json(self):
+        return json.dumps(self.to_dict(), default=float)
+
+    def prometheus(self, tree, prefix='cfs'):
+        self.flush()
+        lines = []
+
+        def histogram(name, histogram, label=''):
+            labels = '{%s}' % label if label else ''
+            label = label + ',' if label else ''
+            for bound, cumulative in histogram.buckets():
+                lines.append('%s_bucket{%sle="%g"} %d' % (name, label, bound,
+                                                         cumulative))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, label,
+                                                        histogram.count))
+            lines.append('%s_sum%s %r' % (name, labels, float(histogram.sum)))
+            lines.append('%s_count%s %d' % (name, labels, histogram.count))
+
+        for name, metric in (('wait_seconds', self.wait),
+                             ('slice_seconds', self.slice),
+                             ('preemptions_per_task', self.preemptions),
+                             ('run_queue_depth', self.depth)):
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            histogram('%s_%s' % (prefix, name), metric)
+        lines.append('# TYPE %s_wait_by_nice_seconds histogram' % prefix)
+        for nice, metric in sorted(self.wait_by_nice.items()):
+            histogram('%s_wait_by_nice_seconds' % prefix, metric,
+                      'nice="%d"' % nice)
+        lines.append('# TYPE %s_preemptions_total counter' % prefix)
+        lines.append('%s_preemptions_total %d' % (prefix,
+                                                  self.total_preemptions))
+        lines.append('# TYPE %s_run_queue_length gauge' % prefix)
+        lines.append('%s_run_queue_length %d' % (prefix, len(tree.tree)))
+        lines.append('# TYPE %s_fairness_error gauge' % prefix)
+        for nice, error in sorted(self.fairness().items()):
+            lines.append('%s_fairness_error{nice="%d"} %r' % (prefix, nice,
+                                                              error))
+        return '\n'.join(lines) + '\n'
+
+
+class Scheduler:
+    """One ProcessTree run queue per cpu, each with its own lock and weight
+    total, so producers and consumers of different cpus do not contend.
+
+    Every balance_every dequeues, and whenever its queue runs empty, a cpu
+    pulls tasks from the busiest queue until their weights differ by less
+    than `imbalance` of their mean. Task ids come from the scheduler so
+    they stay unique when tasks migrate.
+
+    The cpus are threads of one process, so they take turns on the GIL
+    and do not run faster together than alone, see ProcessScheduler.
+    """
+    def __init__(self, cpus=None, balance_every=64, imbalance=0.25,
+                 candidates=8):
+        self.cpus = cpus or os.cpu_count()
+        self.queues = [ProcessTree() for _ in range(self.cpus)]
+        self.locks = [threading.Lock() for _ in range(self.cpus)]
+        self.events = [0] * self.cpus
+        self.balance_every = balance_every
+        self.imbalance = imbalance
+        self.candidates = candidates
+        self.ids = count()
+        self.migrations = 0
+
+    def least_loaded(self):
+        # Unlocked reads, a slightly stale total only makes the choice
+        # less than ideal.
+        return min(range(self.cpus),
+                   key=lambda cpu: self.queues[cpu].total_weight)
+
+    def enqueue(self, task, cpu=None):
+        if not isinstance(task, BaseTask):
+            task = Task(**task)
+        if task.id is None:
+            task.id = next(self.ids)
+        if cpu is None:
+            cpu = self.least_loaded()
+        with self.locks[cpu]:
+            self.queues[cpu].enqueue(task)
+        return cpu
+
+    def dequeue(self, cpu):
+        self.events[cpu] += 1
+        if self.events[cpu] % self.balance_every == 0:
+            self.balance(cpu)
+        with self.locks[cpu]:
+            task = self.queues[cpu].pop_next()
+        if task is None and self.balance(cpu):
+            with self.locks[cpu]:
+                task = self.queues[cpu].pop_next()
+        return task
+
+    def requeue(self, cpu, task, elapsed):
+        task.vruntime += elapsed * nice_0_weight / task.weight
+        with self.locks[cpu]:
+            self.queues[cpu].enqueue(task, wakeup=False)
+
+    def balance(self, cpu):
+        busiest = max(range(self.cpus),
+                      key=lambda other: self.queues[other].total_weight)
+        if busiest == cpu:
+            return 0
+        source, target = self.queues[busiest], self.queues[cpu]
+        moved = 0
+        # Lock in cpu order so two cpus balancing each other can not
+        # deadlock.
+        first, second = sorted((cpu, busiest))
+        with self.locks[first], self.locks[second]:
+            # Move the tasks that would run last on the busiest queue.
+            for task in list(islice(source.tree.values(reverse=True),
+                                    self.candidates)):
+                gap = source.total_weight - target.total_weight
+                mean = (source.total_weight + target.total_weight) / 2
+                if gap <= self.imbalance * mean or len(source.tree) < 2:
+                    break
+                if task.weight >= gap:
+                    continue
+                source.remove_task((source.key(task), task))
+                task.vruntime += target.min_vruntime - source.min_vruntime
+                target.enqueue(task)
+                moved += 1
+        self.migrations += moved
+        return moved
+
+
+class ProcessScheduler:
+    """Like Scheduler one ProcessTree run queue per cpu, but each lives in
+    a worker process of its own, so the cpus schedule and run their tasks
+    at the same time instead of taking turns on the GIL.
+
+    run(tasks, work) spreads the task dicts over the cpus by weight. Each
+    worker runs the leftmost task of its queue with work(task), a
+    picklable function that returns True once the task is done, and
+    requeues it with its vruntime advanced by the time the call took.
+    Every balance_every slices, and while it is idle, a worker publishes
+    its total weight. A worker heavier than the lightest one by more than
+    `imbalance` of their mean sends it the tasks that would run last.
+    """
+    def __init__(self, cpus=None, balance_every=64, imbalance=0.25,
+                 candidates=8):
+        self.cpus = cpus or os.cpu_count()
+        self.balance_every = balance_every
+        self.imbalance = imbalance
+        self.candidates = candidates
+        self.migrations = 0
+
+    def run(self, tasks, work):
+        """Run the tasks to completion, the counts of every cpu."""
+        shares = [[] for _ in range(self.cpus)]
+        loads = [0.0] * self.cpus
+        for id, task in enumerate(tasks):
+            cpu = loads.index(min(loads))
+            shares[cpu].append(dict(task, id=id))
+            loads[cpu] += task.get('weight') or nice_weight(task.get('nice', 0))
+        context = multiprocessing.get_context()
+        inboxes = [context.Queue() for _ in range(self.cpus)]
+        weights = context.Array('d', loads)
+        remaining = context.Value('i', sum(map(len, shares)))
+        results = context.Queue()
+        workers = [context.Process(target=run_cpu, args=(
+            cpu, shares[cpu], work, inboxes, weights, remaining, results,
+            self.balance_every, self.imbalance, self.candidates))
+            for cpu in range(self.cpus)]
+        for worker in workers:
+            worker.start()
+        counts = sorted((results.get() for _ in workers),
+                        key=lambda counts: counts['cpu'])
+        for worker in workers:
+            worker.join()
+        self.migrations += sum(cpu['migrations'] for cpu in counts)
+        return counts
+
+
+def run_cpu(cpu, tasks, work, inboxes, weights, remaining, results,
+            balance_every, imbalance, candidates):
+    """The loop of the worker process of one cpu of a ProcessScheduler."""
+    tree = ProcessTree()
+    counts = {'cpu': cpu, 'slices': 0, 'done': 0, 'busy': 0.0,
+              'migrations': 0}
+
+    def receive(task):
+        # Migrated tasks carry their vruntime relative to the queue's
+        # min_vruntime they left.
+        task = Task(**task)
+        task.vruntime += tree.min_vruntime
+        tree.enqueue(task)
+
+    def balance():
+        with weights.get_lock():
+            weights[cpu] = tree.total_weight
+            lightest = min(range(len(weights)), key=weights.__getitem__)
+        for task in list(islice(tree.tree.values(reverse=True), candidates)):
+            gap = tree.total_weight - weights[lightest]
+            mean = (tree.total_weight + weights[lightest]) / 2
+            if gap <= imbalance * mean or len(tree.tree) < 2:
+                break
+            if task.weight >= gap:
+                continue
+            tree.remove_task((tree.key(task), task))
+            moved = task.to_dict()
+            moved['vruntime'] -= tree.min_vruntime
+            inboxes[lightest].put(moved)
+            with weights.get_lock():
+                weights[lightest] += task.weight
+                weights[cpu] = tree.total_weight
+            counts['migrations'] += 1
+
+    for task in tasks:
+        tree.enqueue(Task(**task))
+    while True:
+        if tree.leftmost is None:
+            # Every task is done once none is left anywhere, so none can
+            # still be on its way to this cpu.
+            if not remaining.value:
+                break
+            weights[cpu] = 0.0
+            try:
+                receive(inboxes[cpu].get(timeout=0.01))
+            except queue.Empty:
+                pass
+            continue
+        if counts['slices'] % balance_every == 0:
+            while True:
+                try:
+                    receive(inboxes[cpu].get_nowait())
+                except queue.Empty:
+                    break
+            balance()
+        task = tree.pick_next()
+        begin = perf_counter()
+        finished = work(task)
+        elapsed = perf_counter() - begin
+        counts['busy'] += elapsed
+        counts['slices'] += 1
+        if finished:
+            tree.remove_task((tree.key(task), task))
+            with remaining.get_lock():
+                remaining.value -= 1
+            counts['done'] += 1
+        else:
+            tree.account(task, elapsed)
+    results.put(counts)
+
+
+class Executor:
+    """Runs the work of the tasks of a ProcessTree on an asyncio loop, one
+    task at a time, always the leftmost one of the run queue.
+
+    Each dispatch gets a slice of `period` seconds (time_slice ms by
+    default) proportional to the task's share of the total weight, after
+    which the task is requeued with its vruntime advanced by the time it
+    ran. Work is a coroutine function, a generator function or a plain
+    callable. Coroutines are preempted at `await executor.checkpoint()`
+    once their slice is used up and generators between two steps, plain
+    callables run to completion in one dispatch.
+
+    If the tree has a weighting its tasks are reweighed once a period.
+    The tree must be empty, tasks get their work through submit().
+    """
+    def __init__(self, tree=None, period=time_slice / 1000, min_slice=0.0005):
+        if tree is not None and len(tree.tree):
+            raise ValueError('the tree is not empty, its %d tasks have no '
+                             'work: submit() them to the Executor instead'
+                             % len(tree.tree))
+        self.tree = tree if tree is not None else ProcessTree()
+        self.period = period
+        self.min_slice = min_slice
+        self.work = {}
+        self.turns = {}
+        self.errors = {}
+        self.runnable_since = {}
+        self.latencies = []
+        self.dispatches = 0
+        self.busy = 0
+        self.elapsed = 0
+        self.reweighed = 0
+        self.current = None
+        self.deadline = 0
+        self.yielded = None
+
+    def submit(self, work, **task):
+        if self.tree.store is not None:
+            task = ColumnTask(self.tree.store, **task)
+        else:
+            task = Task(**task)
+        now = perf_counter()
+        self.tree.enqueue(task, now)
+        self.work[task.id] = work
+        self.runnable_since[task.id] = now
+        return task
+
+    def slice(self, task):
+        return max(self.min_slice, self.period * self.tree.task_weight(task))
+
+    async def checkpoint(self):
+        """Preemption point for coroutine work."""
+        if perf_counter() < self.deadline:
+            return
+        turn = asyncio.get_running_loop().create_future()
+        self.turns[self.current.id] = turn
+        self.yielded.set_result(False)
+        await turn
+
+    async def run_coroutine(self, task, work):
+        try:
+            await work()
+        except Exception as error:
+            self.errors[task.id] = error
+        self.yielded.set_result(True)
+
+    async def dispatch(self, task):
+        """Run the task until its slice is used up, True if it finished."""
+        loop = asyncio.get_running_loop()
+        work = self.work[task.id]
+        if task.id in self.turns or inspect.iscoroutinefunction(work):
+            self.yielded = loop.create_future()
+            if task.id in self.turns:
+                self.turns.pop(task.id).set_result(None)
+            else:
+                loop.create_task(self.run_coroutine(task, work))
+            return await self.yielded
+        if inspect.isgeneratorfunction(work):
+            work = self.work[task.id] = work()
+        try:
+            if inspect.isgenerator(work):
+                for _ in work:
+                    if perf_counter() >= self.deadline:
+                        return False
+            else:
+                work()
+        except Exception as error:
+            self.errors[task.id] = error
+        return True
+
+    async def run(self):
+        start = perf_counter()
+        while self.tree.leftmost is not None:
+            if (self.tree.weighting is not None and
+                    perf_counter() - self.reweighed >= self.period):
+                self.tree.reweigh()
+                self.reweighed = perf_counter()
+            task = self.current = self.tree.pick_next()
+            begin = perf_counter()
+            self.tree.start_task(task, begin)
+            self.latencies.append(begin - self.runnable_since.pop(task.id))
+            self.dispatches += 1
+            self.deadline = begin + self.slice(task)
+            finished = await self.dispatch(task)
+            end = perf_counter()
+            self.busy += end - begin
+            if finished:
+                self.tree.remove_task((self.tree.key(task), task), end)
+                del self.work[task.id]
+                self.tree.stats['done'] = self.tree.stats.get('done', 0) + 1
+            else:
+                self.tree.account(task, end - begin, end)
+                self.runnable_since[task.id] = end
+        self.current = None
+        self.elapsed += perf_counter() - start
+
+    def report(self):
+        """Scheduling latency (time runnable until dispatched) and the
+        time per dispatch spent outside the work itself."""
+        latencies = np.sort(self.latencies)
+        if not len(latencies):
+            return {'dispatches': 0}
+        return {'dispatches': self.dispatches,
+                'latency_mean': latencies.mean(),
+                'latency_p50': latencies[len(latencies) // 2],
+                'latency_p99': latencies[int(len(latencies) * 0.99)],
+                'latency_max': latencies[-1],
+                'overhead_per_dispatch':
+                    (self.elapsed - self.busy) / self.dispatches}
+
+
+def label_grams(label):
+    if len(label) < gram_size:
+        return {label}
+    return {label[i:i + gram_size]
+            for i in range(len(label) - gram_size + 1)}
+
+
+def remove_from(index, key, id):
+    ids = index[key]
+    ids.discard(id)
+    if not ids:
+        del index[key]
+
+
+def nice_weight(nice):
+    return nice_0_weight / 1.25**nice
+
+
+class BaseTask:
+    """The fields and methods shared by Task and ColumnTask, the numeric
+    fields nice, time, vruntime and weight are slots of Task and columns
+    of the TaskStore of a ColumnTask."""
+    __slots__ = ('label', 'text', 'paused', 'start_time', 'last_start',
+                 'runnable_at', 'number', 'id', 'due_date')
+    fields = ('label', 'text', 'nice', 'time', 'paused', 'start_time',
+              'last_start', 'runnable_at', 'number', 'id', 'vruntime',
+              'weight', 'due_date')
 
-class Task:
     def __init__(self, label='', text='', nice=0, time=45, due_date=None,
-                 weight=0, number=0, paused=False, start_time=0):
-        self.label = label
+                 weight=0, number=0, paused=False, start_time=0, id=None,
+                 vruntime=0, last_start=None, runnable_at=None):
+        self.label = sys.intern(label)
         self.text = text
         self.nice = int(nice)
-        self.time = int(time)
+        self.time = float(time)
         self.paused = paused
         self.start_time = start_time
+        # Unlike start_time this is kept when the task is paused.
+        self.last_start = start_time if last_start is None else last_start
+        # When the task last became runnable, None while it runs.
+        self.runnable_at = runnable_at
         self.number = number
+        self.id = id
+        self.vruntime = vruntime
         if weight:
             self.weight = weight
         else:
-            self.weight = 1024 / 1.25**self.nice
-        # if not due_date:
-        #     self.due_date = datetime.now()
-        # else:
-        #     self.due_date = datetime.strptime(due_date, '%Y%m%d %H:%M')
+            self.weight = nice_weight(self.nice)
+        # A timestamp, due dates can also be given as '%Y%m%d %H:%M'.
+        if isinstance(due_date, str):
+            due_date = datetime.strptime(due_date, '%Y%m%d %H:%M').timestamp()
+        self.due_date = due_date
 
     def __repr__(self):
         return '%s - %d - %d' % (self.label, self.nice, self.time)
 
     def __getitem__(self, name):
-        return self.__dict__[name]
+        return getattr(self, name)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.fields
+                if hasattr(self, name)}
+
+
+class Task(BaseTask):
+    __slots__ = ('nice', 'time', 'vruntime', 'weight')
+
+
+class TaskStore:
+    """Parallel arrays of the numeric fields of the tasks of a ProcessTree.
+
+    Every ColumnTask in the tree owns one row. A removed task takes a copy
+    of its values along and gets a new row when it is enqueued again, its
+    old row is reused. The arrays double in size when they are full.
+
+    The store is for working on the columns in bulk, it does not save
+    memory: a ColumnTask takes a little more than a slotted Task.
+    """
+    columns = ('nice', 'weight', 'time', 'vruntime')
+
+    def __init__(self, capacity=1024):
+        self.nice = np.zeros(capacity, dtype=np.int16)
+        self.weight = np.zeros(capacity)
+        self.time = np.zeros(capacity)
+        self.vruntime = np.zeros(capacity)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.free = []
+        self.size = 0
+
+    def allocate(self):
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == len(self.used):
+                self.grow()
+            row = self.size
+            self.size += 1
+        self.used[row] = True
+        return row
+
+    def release(self, task):
+        task.values = {name: getattr(task, name) for name in self.columns}
+        self.used[task.row] = False
+        self.free.append(task.row)
+        task.row = None
+
+    def attach(self, task):
+        task.store = self
+        task.row = self.allocate()
+        for name in self.columns:
+            getattr(self, name)[task.row] = task.values[name]
+        task.values = None
+
+    def grow(self):
+        for name in self.columns + ('used',):
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column,
+                                                np.zeros_like(column)]))
+
+    def reweigh(self):
+        used = self.used
+        self.weight[used] = nice_0_weight / 1.25**self.nice[used]
+
+
+def column(name, convert):
+    # A task without a row was released and holds its own values.
+    def get(task):
+        if task.row is None:
+            return task.values[name]
+        return convert(getattr(task.store, name)[task.row])
+
+    def set(task, value):
+        if task.row is None:
+            task.values[name] = convert(value)
+        else:
+            getattr(task.store, name)[task.row] = value
+    return property(get, set)
+
+
+class ColumnTask(BaseTask):
+    """A Task whose nice, weight, time and vruntime live in a TaskStore."""
+    __slots__ = ('store', 'row', 'values')
+
+    nice = column('nice', int)
+    weight = column('weight', float)
+    time = column('time', float)
+    vruntime = column('vruntime', float)
+
+    def __init__(self, store, **task):
+        self.store = store
+        self.row = store.allocate()
+        super().__init__(**task)
 
 
 def get_tasks():
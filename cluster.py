@@ -1,15 +1,140 @@
+import copy
+import os
 import numpy as np
+import pandas as pd
 import random
 from collections import Counter
+from contextlib import contextmanager
+from itertools import product
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
 import matplotlib.pyplot as plt
 
+# Per-process state of the fit workers, set by init_worker().
+worker_model = None
+worker_memory = None
+worker_shards = {}
+
 
 class NaNException(Exception):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+
+class FuzzyCentroids(object):
+    """The fuzzy centroids of k clusters over p categorical attributes.
+
+    The confidences are stored in one (k, p, max_levels) float array and the
+    terms of each attribute in `levels`, which copies share. Indexing gives
+    the (term, confidence) lists of the nested list layout:
+    centroids[j][l] is the fuzzy set of attribute l in cluster j.
+    """
+    __slots__ = ('values', 'levels')
+
+    def __init__(self, values, levels):
+        self.values = values
+        self.levels = levels
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, j):
+        if not -len(self) <= j < len(self):
+            raise IndexError(j)
+        return FuzzyCluster(self, j % len(self))
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield FuzzyCluster(self, j)
+
+    def __reduce__(self):
+        return (FuzzyCentroids, (self.values, self.levels))
+
+    def __repr__(self):
+        return repr([list(cluster) for cluster in self])
+
+    def fuzzy_set(self, j, l):
+        terms = self.levels[l]
+        return list(zip(terms, self.values[j, l, :len(terms)]))
+
+    def set_fuzzy_set(self, j, l, fuzzy_set):
+        index = {term: t for t, term in enumerate(self.levels[l])}
+        self.values[j, l] = 0
+        for term, confidence in fuzzy_set:
+            self.values[j, l, index[term]] = confidence
+
+    def sums(self):
+        return self.values.sum(axis=2)
+
+    def normalize(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.values /= self.values.sum(axis=2, keepdims=True)
+        return self
+
+    def copy(self):
+        return FuzzyCentroids(self.values.copy(), self.levels)
+
+
+class FuzzyCluster(object):
+    """View of one cluster of a FuzzyCentroids."""
+    __slots__ = ('centroids', 'j')
+
+    def __init__(self, centroids, j):
+        self.centroids = centroids
+        self.j = j
+
+    def __len__(self):
+        return len(self.centroids.levels)
+
+    def __getitem__(self, l):
+        return self.centroids.fuzzy_set(self.j, l)
+
+    def __setitem__(self, l, fuzzy_set):
+        self.centroids.set_fuzzy_set(self.j, l, fuzzy_set)
+
+    def __iter__(self):
+        for l in range(len(self)):
+            yield self.centroids.fuzzy_set(self.j, l)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class SparseCentroids(object):
+    """Pruned fuzzy centroids, only the retained terms are stored.
+
+    terms[j, l] holds the sorted codes of the retained terms of attribute l
+    in cluster j, padded with max_levels, and values[j, l] their
+    confidences, padded with 0. The mass of the `dropped` other terms is
+    kept in `other` and spread evenly over them.
+    """
+    __slots__ = ('terms', 'values', 'other', 'dropped')
+
+    def __init__(self, terms, values, other, dropped):
+        self.terms = terms
+        self.values = values
+        self.other = other
+        self.dropped = dropped
+
+    def __reduce__(self):
+        return (SparseCentroids,
+                (self.terms, self.values, self.other, self.dropped))
+
+    def share(self):
+        return self.other / np.maximum(self.dropped, 1)
+
+    def to_dense(self, mask):
+        k, p, _ = self.terms.shape
+        centroids = np.zeros((k, p, mask.shape[1] + 1))
+        centroids[..., :-1] = mask * self.share()[..., None]
+        np.put_along_axis(centroids, self.terms, self.values, axis=2)
+        return centroids[..., :-1]
+
+
 class FuzzyKmodesFuzzyCentroids(object):
-    def __init__(self, X, y=None, k=2, m=1.5, n_iter=10, error=0.00005):
+    def __init__(self, X, y=None, k=2, m=1.5, n_iter=10, error=0.00005,
+                 n_jobs=1, top_n=None, threshold=None):
         self.X = X
         self.y = y
         self.k = k
@@ -22,6 +147,53 @@ class FuzzyKmodesFuzzyCentroids(object):
         self.clusters = None
         self.exp = 1 / ( self.m - 1 )
         self.error = error
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.top_n = top_n
+        self.threshold = threshold
+        self.pruning = None
+        self.encode(X)
+
+    def encode(self, X):
+        # Label-encode every column once, the codes index the last axis of
+        # the (k, p, max_levels) centroid arrays used by fit().
+        levels = []
+        codes = np.empty((self.n, self.p), dtype=np.intp)
+        for l, attribute in enumerate(self.columns):
+            codes[:, l], uniques = pd.factorize(X[attribute],
+                                                use_na_sentinel=False)
+            levels.append(np.asarray(uniques))
+        self.use_codes(codes, levels)
+
+    def use_codes(self, codes, levels):
+        self.codes = codes
+        self.levels = levels
+        self.p = len(levels)
+        self.n_levels = np.array([len(terms) for terms in self.levels])
+        self.max_levels = self.n_levels.max()
+        self.mask = np.arange(self.max_levels) < self.n_levels[:, None]
+        # Offset each column's codes into its own block of max_levels
+        # buckets so one bincount covers every attribute of a cluster.
+        self.flat_codes = (codes + np.arange(self.p) * self.max_levels).ravel()
+        self.postings = None
+        self.index = [{term: t for t, term in enumerate(terms)}
+                      for terms in self.levels]
+
+    def clone(self, k=None, m=None, columns=None):
+        """Copy of the model with other parameters that shares the encoded
+        data instead of encoding X again."""
+        model = copy.copy(self)
+        if k is not None:
+            model.k = k
+        if m is not None:
+            model.m = m
+            model.exp = 1 / (m - 1)
+        if columns is not None:
+            picked = [self.columns.get_loc(column) for column in columns]
+            model.columns = self.columns[picked]
+            model.use_codes(self.codes[:, picked],
+                            [self.levels[l] for l in picked])
+        model.u = model.clusters = None
+        return model
 
     def random_numbers(self, values):
         randoms = np.random.dirichlet(np.ones(len(values)), size=1)
@@ -41,12 +213,16 @@ class FuzzyKmodesFuzzyCentroids(object):
                 for column, fuzzy_set in enumerate(cluster))
 
     def membership(self, row, cluster, clusters):
-        membership = sum((self.distance(cluster, row) /
-                          self.distance(other_cluster, row))** self.exp
-                         for other_cluster in clusters)
-        if np.isnan(membership):
-            return 0
-        return membership ** -1
+        distance = self.distance(cluster, row)
+        distances = [self.distance(other_cluster, row)
+                     for other_cluster in clusters]
+        # A row that coincides with one or more centroids belongs to those
+        # centroids only, shared equally.
+        zeros = sum(other <= 0 for other in distances)
+        if zeros:
+            return (distance <= 0) / zeros
+        return sum((distance / other) ** self.exp
+                   for other in distances) ** -1
 
     def certainty(self, column, value, cluster_u):
         new_memb = sum(cluster_u[row] ** self.m if x == value else 0
@@ -54,63 +230,280 @@ class FuzzyKmodesFuzzyCentroids(object):
         return new_memb
 
     def update_clusters(self, clusters, X, u):
+        certainties = self.certainties(np.asarray(u))
+        if isinstance(clusters, FuzzyCentroids):
+            clusters.values[...] = certainties
+            return clusters
         for j, cluster in enumerate(clusters):
-            cluster_u = u[j]
             for l, term_membership in enumerate(cluster):
-                feature = self.columns[l]
-                column = X[feature].values
-                clusters[j][l] = [(term, self.certainty(column, term, cluster_u))
+                index = self.index[l]
+                clusters[j][l] = [(term, certainties[j, l, index[term]])
                                 for term, _ in term_membership]
         return clusters
 
     def check_normal(self, clusters, iter):
-        clusters = [[self.normalize(row) for row in cluster]
-                    for cluster in clusters]
-        for cluster in clusters:
-            for row in cluster:
-                if not (0.9 < sum(r[1] for r in row) < 1.1):
-                    print('error', row)
-                    print('error', sum(r[1] for r in row))
-                    raise NaNException(str(iter) + str(cluster))
+        if not isinstance(clusters, FuzzyCentroids):
+            clusters = self.to_clusters(self.to_array(clusters))
+        self.check_sums(clusters.normalize(), iter)
         return clusters
 
+    def check_sums(self, clusters, iter):
+        summed = clusters.sums()
+        if not ((0.9 < summed) & (summed < 1.1)).all():
+            print('error', summed)
+            raise NaNException(str(iter) + str(clusters))
+
     def normalize(self, row):
         summed = sum(r[1] for r in row)
         return [(value, x / summed) for value, x in row]
 
-    def fit(self, init=None, memberships=False):
-        if not init:
-            clusters = self.init(self.X, self.k)
+    def random_centroids(self):
+        centroids = np.zeros((self.k, self.p, self.max_levels))
+        for j in range(self.k):
+            for l, n_levels in enumerate(self.n_levels):
+                centroids[j, l, :n_levels] = np.random.dirichlet(
+                    np.ones(n_levels), size=1)[0]
+        return centroids
+
+    def to_array(self, clusters):
+        if isinstance(clusters, FuzzyCentroids) and \
+                clusters.levels is self.levels:
+            return clusters.values.copy()
+        centroids = np.zeros((self.k, self.p, self.max_levels))
+        for j, cluster in enumerate(clusters):
+            for l, fuzzy_set in enumerate(cluster):
+                for term, confidence in fuzzy_set:
+                    centroids[j, l, self.index[l][term]] = confidence
+        return centroids
+
+    def to_clusters(self, centroids):
+        return FuzzyCentroids(centroids, self.levels)
+
+    def term_weights(self, centroids):
+        return centroids
+
+    def sparse_weights(self, centroids):
+        return centroids.values, centroids.share()
+
+    def rows_by_term(self):
+        # Inverted index of the flat codes: the rows of flat code f are
+        # rows[bounds[f]:bounds[f + 1]].
+        if self.postings is None:
+            order = np.argsort(self.flat_codes, kind='stable')
+            bounds = np.zeros(self.p * self.max_levels + 1, dtype=np.intp)
+            np.cumsum(np.bincount(self.flat_codes,
+                                  minlength=self.p * self.max_levels),
+                      out=bounds[1:])
+            self.postings = (order // self.p, bounds)
+        return self.postings
+
+    def sparse_distances(self, centroids):
+        # Every row matches the even share of the other bucket, plus the
+        # difference to the confidence of its term for the rows of the
+        # retained terms, found in the inverted index.
+        rows, bounds = self.rows_by_term()
+        values, share = self.sparse_weights(centroids)
+        totals = values.sum(axis=2) + share * centroids.dropped
+        retained = centroids.terms < self.max_levels
+        offsets = (np.arange(self.p) * self.max_levels)[:, None]
+        n = len(self.flat_codes) // self.p
+        distances = np.empty((self.k, n))
+        for j in range(self.k):
+            flat = (centroids.terms[j] + offsets)[retained[j]]
+            lengths = bounds[flat + 1] - bounds[flat]
+            ends = np.cumsum(lengths)
+            picked = np.arange(ends[-1] if len(ends) else 0) + np.repeat(
+                bounds[flat] - ends + lengths, lengths)
+            matched = np.bincount(
+                rows[picked],
+                weights=np.repeat((values[j] - share[j][:, None])[retained[j]],
+                                  lengths),
+                minlength=n)
+            distances[j] = totals[j].sum() - share[j].sum() - matched
+        return distances
+
+    def distances(self, centroids):
+        if isinstance(centroids, SparseCentroids):
+            return self.sparse_distances(centroids)
+        weights = self.term_weights(centroids)
+        matched = weights.reshape(self.k, -1)[:, self.flat_codes]
+        matched = matched.reshape(self.k, -1, self.p).sum(axis=2)
+        return weights.sum(axis=(1, 2))[:, None] - matched
+
+    def memberships(self, centroids):
+        return self.distance_memberships(self.distances(centroids))
+
+    def distance_memberships(self, distances):
+        # u[c] = d_c ** -exp / sum_o d_o ** -exp, scaled by the nearest
+        # distance of each row so the powers can not overflow.
+        distances = np.maximum(distances, 0)
+        zero = distances == 0
+        nearest = distances.min(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = (nearest / distances) ** self.exp
+        u = ratios / ratios.sum(axis=0)
+        coincident = zero.any(axis=0)
+        u[:, coincident] = zero[:, coincident] / zero[:, coincident].sum(axis=0)
+        return u
+
+    def certainties(self, u):
+        # Weighted bincount: every row adds u ** m to the bucket of its
+        # term, one pass over the codes per cluster.
+        weights = u ** self.m
+        size = self.p * self.max_levels
+        centroids = np.empty((self.k, self.p, self.max_levels))
+        for j in range(self.k):
+            centroids[j] = np.bincount(self.flat_codes,
+                                       weights=np.repeat(weights[j], self.p),
+                                       minlength=size).reshape(self.p, -1)
+        return centroids
+
+    def step(self, centroids):
+        u = self.memberships(centroids)
+        return u, self.certainties(u)
+
+    def shard(self, start, stop):
+        shard = copy.copy(self)
+        shard.flat_codes = self.flat_codes[start * self.p:stop * self.p]
+        shard.n = stop - start
+        shard.postings = None
+        return shard
+
+    @contextmanager
+    def workers(self):
+        # Share the flat codes with a pool of processes, each one fits a
+        # contiguous block of rows and step() concatenates the memberships
+        # and sums the per-term certainties of the blocks.
+        if self.n_jobs <= 1:
+            yield self.step
+            return
+        memory = SharedMemory(create=True, size=self.flat_codes.nbytes)
+        codes = np.ndarray(self.flat_codes.shape, self.flat_codes.dtype,
+                           buffer=memory.buf)
+        try:
+            codes[:] = self.flat_codes
+            model = copy.copy(self)
+            model.X = model.y = model.codes = model.flat_codes = None
+            model.postings = None
+            bounds = np.linspace(0, self.n, self.n_jobs + 1).astype(int)
+            with Pool(self.n_jobs, initializer=init_worker,
+                      initargs=(memory.name, codes.shape, codes.dtype,
+                                model)) as pool:
+                def step(centroids):
+                    shards = pool.starmap(fit_shard,
+                                          [(start, stop, centroids) for
+                                           start, stop in zip(bounds[:-1],
+                                                              bounds[1:])])
+                    return (np.concatenate([u for u, _ in shards], axis=1),
+                            sum(certainties for _, certainties in shards))
+                yield step
+        finally:
+            del codes
+            memory.close()
+            memory.unlink()
+
+    def normalize_centroids(self, centroids, iter):
+        clusters = self.to_clusters(centroids.copy()).normalize()
+        self.check_sums(clusters, iter)
+        return clusters.values
+
+    def prune_width(self):
+        # Normalized confidences sum to 1, so at most 1 / threshold terms
+        # of a fuzzy set reach the threshold.
+        width = self.max_levels
+        if self.threshold:
+            width = min(width, int(1 / self.threshold) + 1)
+        if self.top_n is not None:
+            width = min(width, self.top_n)
+        return width
+
+    def prune_centroids(self, centroids):
+        """Keep the top_n terms and/or the terms with at least `threshold`
+        confidence of every fuzzy set as SparseCentroids. The mass of the
+        other terms is put in a single bucket that is spread evenly over
+        them."""
+        if self.top_n is None and self.threshold is None:
+            return centroids
+        width = self.prune_width()
+        scores = np.where(self.mask, centroids, -1)
+        if width < self.max_levels:
+            top = np.argpartition(-scores, width - 1, axis=2)[..., :width]
         else:
-            clusters = init
+            top = np.broadcast_to(np.arange(self.max_levels), scores.shape)
+        values = np.take_along_axis(scores, top, axis=2)
+        keep = values >= (self.threshold or 0)
+        terms = np.where(keep, top, self.max_levels)
+        order = np.argsort(terms, axis=2)
+        terms = np.take_along_axis(terms, order, axis=2)
+        values = np.take_along_axis(np.where(keep, values, 0), order, axis=2)
+        other = np.maximum(centroids.sum(axis=2) - values.sum(axis=2), 0)
+        return SparseCentroids(terms, values, other,
+                               self.n_levels - keep.sum(axis=2))
 
-        clusters = self.check_normal(clusters, -2)
-        u = [[self.membership(row, cluster, clusters) for row in self.X.values]
-            for cluster in clusters]
-        clusters = self.update_clusters(clusters, self.X, u)
-        clusters = self.check_normal(clusters, -1)
+    def pruning_report(self, centroids, seconds):
+        terms = self.k * self.mask.sum()
+        kept = (centroids.terms < self.max_levels).sum()
+        return {'top_n': self.top_n, 'threshold': self.threshold,
+                'kept_terms': int(kept), 'terms': int(terms),
+                'kept': float(kept / terms), 'seconds': seconds}
 
-        self.iteration = 0
-        u_error = 1
-        while self.iteration < self.n_iter and u_error > self.error:
-            try:
-                new_u = [[self.membership(x, cluster, clusters) for x in
-                        self.X.values]
-                        for cluster in clusters]
-                clusters_new = self.update_clusters(clusters, self.X, new_u)
-                clusters_new = self.check_normal(clusters_new, self.iteration)
-                u_error = np.mean([abs(m - new_m) for i in range(self.k)
-                            for m, new_m in zip(u[i], new_u[i])])
-                # print(clusters)
-                u = new_u
-                clusters = clusters_new
-            except NaNException:
-                print('nan')
-                break
-            finally:
-                self.iteration += 1
+    def fit(self, init=None, memberships=False, baseline=False):
+        """Fit the centroids from `init` or random ones.
+
+        With pruning and `baseline`, the model is also fitted without
+        pruning from the same initial centroids and the pruning report
+        gets the baseline's seconds, the speedup and the mean difference
+        of the memberships.
+        """
+        if init is None:
+            centroids = self.random_centroids()
+        else:
+            centroids = self.to_array(init)
+        if baseline and (self.top_n is not None or
+                         self.threshold is not None):
+            unpruned = self.clone()
+            unpruned.top_n = unpruned.threshold = None
+            unpruned.fit(self.to_clusters(centroids))
+        start = perf_counter()
+        self.pruning = None
+
+        with self.workers() as step:
+            centroids = self.normalize_centroids(centroids, -2)
+            u, centroids = step(self.prune_centroids(centroids))
+            centroids = self.prune_centroids(
+                self.normalize_centroids(centroids, -1))
+
+            self.iteration = 0
+            u_error = 1
+            while self.iteration < self.n_iter and u_error > self.error:
+                try:
+                    new_u, centroids_new = step(centroids)
+                    centroids_new = self.prune_centroids(
+                        self.normalize_centroids(centroids_new,
+                                                 self.iteration))
+                    u_error = np.mean(np.abs(u - new_u))
+                    u = new_u
+                    centroids = centroids_new
+                except NaNException:
+                    print('nan')
+                    break
+                finally:
+                    self.iteration += 1
+        seconds = perf_counter() - start
         self.u = u
-        self.clusters = clusters
+        self.u_error = u_error
+        self.centroids = centroids
+        if isinstance(centroids, SparseCentroids):
+            self.clusters = self.to_clusters(centroids.to_dense(self.mask))
+            self.pruning = self.pruning_report(centroids, seconds)
+            if baseline:
+                self.pruning.update(
+                    baseline_seconds=unpruned.seconds,
+                    speedup=unpruned.seconds / seconds,
+                    membership_error=np.mean(np.abs(unpruned.u - u)))
+        else:
+            self.clusters = self.to_clusters(centroids)
+        self.seconds = seconds
         if memberships:
             return self.cluster_membership()
 
@@ -118,7 +511,7 @@ class FuzzyKmodesFuzzyCentroids(object):
         cluster_membership = {i: list() for i in range(self.k)}
         for i in range(self.n):
             cluster = max((self.u[cl][i], cl) for cl in range(self.k))[-1]
-            if type(self.y) is not None:
+            if self.y is not None:
                 value = self.y[i]
             else:
                 value = i
@@ -128,6 +521,10 @@ class FuzzyKmodesFuzzyCentroids(object):
     def count_values(self, cluster_membership):
         return {cl: Counter(vals) for cl, vals in cluster_membership.items()}
 
+    def purity(self, counts):
+        return sum(max(values.values(), default=0)
+                   for values in counts.values()) / self.n
+
     def plot_clusters(self):
         cluster_membership = self.cluster_membership()
         cluster_membershp = {cl: Counter(vals)
@@ -142,9 +539,165 @@ class FuzzyKmodesFuzzyCentroids(object):
 
 
 class FuzzyKmodes(FuzzyKmodesFuzzyCentroids):
-    def __init__(self, X, y=None, k=2, m=1.5, n_iter=10, error=0.00005):
-        super().__init__(X, y=y, k=k, m=m, n_iter=n_iter, error=error)
+    def __init__(self, X, y=None, k=2, m=1.5, n_iter=10, error=0.00005,
+                 n_jobs=1, top_n=None, threshold=None):
+        super().__init__(X, y=y, k=k, m=m, n_iter=n_iter, error=error,
+                         n_jobs=n_jobs, top_n=top_n, threshold=threshold)
 
     def dissimilarity(self, fuzzy_set, value):
         return sum(0 if term == value else 1
                 for term, confidence in fuzzy_set)
+
+    def term_weights(self, centroids):
+        return np.broadcast_to(self.mask, centroids.shape).astype(float)
+
+    def sparse_weights(self, centroids):
+        return ((centroids.terms < self.max_levels).astype(float),
+                np.ones(centroids.dropped.shape))
+
+
+class MiniBatchFuzzyKmodesFuzzyCentroids(FuzzyKmodesFuzzyCentroids):
+    """Fuzzy centroids learned from a stream of DataFrame chunks, e.g.
+    pd.read_csv(path, chunksize=...), with only one chunk in memory.
+
+    The per-term certainties of every chunk are added to accumulators that
+    decay by `decay` per chunk, the centroids are the normalized
+    accumulators. Terms are added to the vocabulary as they show up.
+    """
+    def __init__(self, columns=None, k=2, m=1.5, n_iter=10, error=0.00005,
+                 decay=0.9):
+        self.X = None
+        self.y = None
+        self.k = k
+        self.m = m
+        self.n_iter = n_iter
+        self.columns = None if columns is None else pd.Index(columns)
+        self.u = None
+        self.clusters = None
+        self.exp = 1 / ( self.m - 1 )
+        self.error = error
+        self.n_jobs = 1
+        self.decay = decay
+        self.levels = None
+        self.centroids = None
+        self.accumulated = None
+        self.history = []
+
+    def encode(self, X):
+        if self.columns is None:
+            self.columns = X.columns
+        if self.levels is None:
+            self.levels = [np.array([], dtype=object) for _ in self.columns]
+        self.n = len(X)
+        levels = []
+        codes = np.empty((self.n, len(self.columns)), dtype=np.intp)
+        for l, attribute in enumerate(self.columns):
+            column = X[attribute]
+            terms = self.levels[l]
+            new = column[~column.isin(terms)].unique()
+            if len(new):
+                terms = np.concatenate([terms, np.asarray(new)])
+            codes[:, l] = pd.Index(terms).get_indexer(column)
+            levels.append(terms)
+        self.use_codes(codes, levels)
+
+    def pad(self, centroids):
+        return np.pad(centroids, ((0, 0), (0, 0),
+                                  (0, self.max_levels - centroids.shape[2])))
+
+    def partial_fit(self, chunk):
+        self.encode(chunk)
+        if self.centroids is None:
+            centroids = self.random_centroids()
+            accumulated = np.zeros_like(centroids)
+        else:
+            centroids = self.pad(self.centroids)
+            accumulated = self.decay * self.pad(self.accumulated)
+        previous = centroids = self.normalize_centroids(centroids, -1)
+
+        iteration = 0
+        u_error = 1
+        u = self.memberships(centroids)
+        while iteration < self.n_iter and u_error > self.error:
+            try:
+                centroids_new = self.normalize_centroids(
+                    accumulated + self.certainties(u), iteration)
+                new_u = self.memberships(centroids_new)
+                u_error = np.mean(np.abs(u - new_u))
+                u = new_u
+                centroids = centroids_new
+            except NaNException:
+                print('nan')
+                break
+            finally:
+                iteration += 1
+
+        self.accumulated = accumulated + self.certainties(u)
+        self.centroids = self.normalize_centroids(self.accumulated, iteration)
+        self.u = u
+        self.clusters = self.to_clusters(self.centroids)
+        report = {'batch': len(self.history), 'rows': self.n,
+                  'iterations': iteration, 'u_error': u_error,
+                  'shift': np.mean(np.abs(self.centroids - previous))}
+        self.history.append(report)
+        return report
+
+
+def init_worker(name, shape, dtype, model):
+    global worker_model, worker_memory
+    worker_memory = SharedMemory(name=name)
+    model.flat_codes = np.ndarray(shape, dtype, buffer=worker_memory.buf)
+    worker_model = model
+
+
+def fit_shard(start, stop, centroids):
+    # Keep the shards, and their inverted index, for the next iterations.
+    if (start, stop) not in worker_shards:
+        worker_shards[start, stop] = worker_model.shard(start, stop)
+    return worker_shards[start, stop].step(centroids)
+
+
+def sweep(X, y=None, ks=(2,), ms=(1.5,), seeds=(None,), columns=(None,),
+          n_jobs=None, model=FuzzyKmodes, **kwargs):
+    """Fit `model` for every combination of column subset, k, m and seed.
+
+    X is encoded once and the grid is spread over a pool of n_jobs
+    processes (all CPUs by default). Results are yielded as soon as each
+    fit finishes, so they come in completion order, not grid order.
+    """
+    base = model(X, y, **kwargs)
+    base.X = None
+    base.n_jobs = 1
+    grid = product(columns, ks, ms, seeds)
+    if n_jobs == 1:
+        for params in grid:
+            yield sweep_fit(params, base)
+        return
+    with Pool(n_jobs, initializer=init_sweep, initargs=(base,)) as pool:
+        yield from pool.imap_unordered(sweep_fit, grid)
+
+
+def init_sweep(model):
+    global worker_model
+    worker_model = model
+    # Forked workers inherit the parent's random state, reseed them from
+    # the OS so fits without a seed are independent restarts.
+    np.random.seed()
+    random.seed()
+
+
+def sweep_fit(params, base=None):
+    columns, k, m, seed = params
+    model = (base or worker_model).clone(k=k, m=m, columns=columns)
+    if seed is not None:
+        np.random.seed(seed)
+    model.fit()
+    result = {'columns': list(model.columns), 'k': k, 'm': m, 'seed': seed,
+              'iterations': model.iteration, 'u_error': model.u_error}
+    if model.pruning:
+        result['pruning'] = model.pruning
+    if model.y is not None:
+        counts = model.count_values(model.cluster_membership())
+        result['counts'] = counts
+        result['purity'] = model.purity(counts)
+    return result
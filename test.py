@@ -2,26 +2,24 @@ from itertools import combinations
 
 import pandas as pd
 
-from cluster import FuzzyKmodes
+from cluster import sweep
 
 
-df = pd.read_csv('Data_fuzzy-shrooms.csv').dropna()
-print(df.shape)
-X = df.drop('class', axis=1)
-print(X.columns)
-columns = combinations(X.columns, 2)
-y = df['class']
-# nancols = ['bruises', 'veil-type']
-for i in range(1, 10):
-    m = 1 + (i * 0.1)
-    clust = FuzzyKmodes(X, y, m=m)
-    clust.cluster()
-    print(m)
-    print(clust.count_values(clust.cluster_membership()))
-'''
-for col in columns:
-    clust = FuzzyKmodes(X[list(col)].dropna(), y)
-    print(col)
-    clust.cluster()
-    print(clust.count_values(clust.cluster_membership()))
-'''
+if __name__ == '__main__':
+    df = pd.read_csv('Data_fuzzy-shrooms.csv').dropna()
+    print(df.shape)
+    X = df.drop('class', axis=1)
+    print(X.columns)
+    columns = combinations(X.columns, 2)
+    y = df['class']
+    # nancols = ['bruises', 'veil-type']
+    ms = [1 + (i * 0.1) for i in range(1, 10)]
+    for result in sweep(X, y, ms=ms):
+        print(result['m'], result['iterations'], result['u_error'],
+              result['purity'])
+        print(result['counts'])
+    '''
+    for result in sweep(X, y, columns=columns):
+        print(result['columns'], result['purity'])
+        print(result['counts'])
+    '''